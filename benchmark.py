@@ -0,0 +1,333 @@
+# benchmark.py
+"""Offline load test for the bot's real handlers.
+
+Telegram and Gemini are replaced by in-process stand-ins: a stub model with
+configurable latency and reply length, and a fake bot that only records the
+messages it is asked to send. Each virtual user runs a session against the
+real handlers (``start_command``, ``handle_message`` with conversation,
+search and reminder messages, ``settings_command``) and the harness reports
+throughput, p50/p99 handler latency and the cost of persisting user state,
+for every combination of user count and history length.
+
+    python benchmark.py --users 10,100,1000 --history 0,20,40 --messages 5
+
+No network access or API keys are needed; all state lives in a temporary
+directory that is removed afterwards.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+from history import MODEL, USER, ConversationHistory, encode_json
+
+SAMPLE_MESSAGES = [
+    ("conversation", "كيف كان يومك يا ماهيرو؟ أنا تعبت كثيراً اليوم في العمل"),
+    ("conversation", "ما رأيك أن نطبخ الأرز بالكاري على العشاء؟"),
+    ("conversation", "tell me something nice about your day"),
+    ("search", "ابحثي عن أفضل وصفات الأرز"),
+    ("reminder", "ذكريني بشرب الماء بعد ساعة"),
+    ("reminder", "remind me to call mom in 20 minutes"),
+    ("reminder", "ذكريني بالاجتماع مع الفريق في وقت لاحق"), # يحتاج إلى النموذج
+]
+
+FILLER_WORDS = "حسناً لا بأس سأكون هنا دائماً من أجلك يا صديقي هل أكلت جيداً اليوم لا تنسَ أن ترتاح قليلاً".split()
+
+
+# --- النموذج البديل: زمن استجابة وطول رد قابلان للضبط ---
+class StubUsage:
+    __slots__ = ("total_token_count",)
+
+    def __init__(self, total_token_count):
+        self.total_token_count = total_token_count
+
+
+class StubResponse:
+    """Looks like a Gemini response; iterating it yields the streamed chunks."""
+
+    def __init__(self, text: str, chunks=None, chunk_delay: float = 0.0):
+        self.text = text
+        self.usage_metadata = StubUsage(len(text) // 3 + 50)
+        self._chunks = chunks or [text]
+        self._chunk_delay = chunk_delay
+
+    async def __aiter__(self):
+        for chunk in self._chunks:
+            await asyncio.sleep(self._chunk_delay)
+            yield StubResponse(chunk)
+
+
+class StubModel:
+    """Answers every call site of the bot after a log-normally distributed delay."""
+
+    def __init__(self, latency: float = 0.5, jitter: float = 0.5, reply_words: int = 40, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.reply_words = reply_words
+        self.random = random.Random(seed)
+        self.calls = 0
+
+    def _delay(self) -> float:
+        if self.latency <= 0:
+            return 0.0
+        return self.latency * self.random.lognormvariate(0, self.jitter)
+
+    def _reply(self) -> str:
+        count = max(1, int(self.random.gauss(self.reply_words, self.reply_words / 4)))
+        return " ".join(self.random.choice(FILLER_WORDS) for _ in range(count))
+
+    def _answer(self, contents, generation_config) -> str:
+        if isinstance(contents, str) and '"delay_seconds"' in contents:
+            return json.dumps({"task": "الاجتماع مع الفريق", "delay_seconds": 3600}, ensure_ascii=False)
+        if isinstance(contents, str) and '"intent"' in contents:
+            match = re.search(r"المستخدم: '(.*?)'\.", contents, re.S)
+            return json.dumps({"intent": "conversation", "data": match.group(1) if match else ""}, ensure_ascii=False)
+        if generation_config and generation_config.get("response_mime_type") == "application/json":
+            return json.dumps({"intent": "conversation", "data": "", "reply": self._reply()}, ensure_ascii=False)
+        return self._reply()
+
+    async def generate_content_async(self, contents, stream=False, generation_config=None, **kwargs):
+        self.calls += 1
+        text = self._answer(contents, generation_config)
+        if stream:
+            words = text.split(" ")
+            chunks = [" ".join(words[i:i + 8]) + " " for i in range(0, len(words), 8)]
+            await asyncio.sleep(self._delay() / 2)
+            return StubResponse(text, chunks, chunk_delay=self._delay() / (2 * len(chunks)))
+        await asyncio.sleep(self._delay())
+        return StubResponse(text)
+
+
+# --- بديل تيليجرام: يسجل الرسائل الصادرة فقط ---
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+        return FakeMessage(self, chat_id, text)
+
+    async def send_chat_action(self, chat_id, action, **kwargs):
+        return True
+
+
+class FakeMessage:
+    __slots__ = ("bot", "chat_id", "text")
+
+    def __init__(self, bot: FakeBot, chat_id, text):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.text = text
+
+    async def reply_text(self, text, **kwargs):
+        return await self.bot.send_message(self.chat_id, text)
+
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+        return self
+
+
+class FakeUser:
+    __slots__ = ("id", "first_name")
+
+    def __init__(self, user_id, first_name):
+        self.id = user_id
+        self.first_name = first_name
+
+
+class FakeChat:
+    __slots__ = ("id", "type")
+
+    def __init__(self, chat_id):
+        self.id = chat_id
+        self.type = "private"
+
+
+class FakeUpdate:
+    """The parts of ``telegram.Update`` the handlers read."""
+
+    __slots__ = ("effective_user", "effective_chat", "message")
+
+    def __init__(self, bot: FakeBot, user_id: int, text: str):
+        self.effective_user = FakeUser(user_id, f"User{user_id}")
+        self.effective_chat = FakeChat(user_id)
+        self.message = FakeMessage(bot, user_id, text)
+
+
+class FakeApplication:
+    def __init__(self, bot: FakeBot):
+        self.bot = bot
+        self.tasks = set()
+
+    def create_task(self, coroutine):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+
+class FakeContext:
+    __slots__ = ("application", "bot", "args", "job")
+
+    def __init__(self, application: FakeApplication, args=None):
+        self.application = application
+        self.bot = application.bot
+        self.args = args or []
+        self.job = None
+
+
+def percentile(sorted_values, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def synthetic_history(length: int, rng: random.Random) -> ConversationHistory:
+    history = ConversationHistory()
+    for i in range(length):
+        history.append(USER if i % 2 == 0 else MODEL, " ".join(rng.choice(FILLER_WORDS) for _ in range(30)))
+    return history
+
+
+async def run_scenario(bot, stub: StubModel, users: int, history: int, messages: int, concurrency: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    fake_bot = FakeBot()
+    application = FakeApplication(fake_bot)
+
+    # حالة نظيفة لكل سيناريو مع سجلات محادثة بالطول المطلوب
+    bot.user_data.clear()
+    with bot.user_store._lock:
+        with bot.user_store._conn:
+            bot.user_store._conn.execute("DELETE FROM user_state")
+    base_id = 10_000_000
+    for user_id in range(base_id, base_id + users):
+        bot.initialize_user_data(user_id, f"User{user_id}")
+        bot.user_data[str(user_id)]['conversation_history'] = synthetic_history(history, rng)
+    await bot.state_writer.flush()
+
+    latencies = []
+    limit = asyncio.Semaphore(concurrency)
+
+    async def timed(handler, update, context):
+        started = time.perf_counter()
+        await handler(update, context)
+        latencies.append(time.perf_counter() - started)
+
+    async def session(user_id):
+        async with limit:
+            await timed(bot.start_command, FakeUpdate(fake_bot, user_id, "/start"), FakeContext(application))
+            for _ in range(messages):
+                _, text = rng.choice(SAMPLE_MESSAGES)
+                await timed(bot.handle_message, FakeUpdate(fake_bot, user_id, text), FakeContext(application))
+            await timed(bot.settings_command, FakeUpdate(fake_bot, user_id, "/settings Africa/Cairo"), FakeContext(application, ["Africa/Cairo"]))
+
+    calls_before = stub.calls
+    started = time.perf_counter()
+    await asyncio.gather(*(session(user_id) for user_id in range(base_id, base_id + users)))
+    elapsed = time.perf_counter() - started
+    # التلخيص الخلفي ليس جزءاً من زمن الرد، لكن ننتظره قبل قياس الحفظ
+    if application.tasks:
+        await asyncio.gather(*application.tasks)
+
+    # كلفة الحفظ: الكتابة التدريجية الحالية مقابل إعادة كتابة ملف JSON كامل كما كان سابقاً
+    pending = bot.state_writer.pending
+    dirty_bytes = sum(len(bot.user_store.dump(bot.user_data[user_id]).encode('utf-8')) for user_id in bot.state_writer._dirty if user_id in bot.user_data)
+    flush_started = time.perf_counter()
+    await bot.state_writer.flush()
+    flush_seconds = time.perf_counter() - flush_started
+
+    rewrite_started = time.perf_counter()
+    with open("full_rewrite.json", 'w', encoding='utf-8') as f:
+        json.dump(dict(bot.user_data), f, ensure_ascii=False, indent=4, default=encode_json)
+    rewrite_seconds = time.perf_counter() - rewrite_started
+    rewrite_bytes = os.path.getsize("full_rewrite.json")
+
+    latencies.sort()
+    return {
+        "users": users,
+        "history": history,
+        "updates": len(latencies),
+        "seconds": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "llm_calls": stub.calls - calls_before,
+        "sent": len(fake_bot.sent),
+        "flush_users": pending,
+        "flush_ms": flush_seconds * 1000,
+        "flush_kb": dirty_bytes / 1024,
+        "rewrite_ms": rewrite_seconds * 1000,
+        "rewrite_kb": rewrite_bytes / 1024,
+    }
+
+
+def load_bot(workdir: str, stub: StubModel, stream: bool, llm_concurrency: int):
+    # البوت يقرأ الإعدادات عند الاستيراد، لذا نضبطها قبل استيراده
+    os.environ['USER_STATE_DB'] = os.path.join(workdir, "user_state.db")
+    os.environ['REMINDERS_DB'] = os.path.join(workdir, "reminders.db")
+    os.environ['STREAM_REPLIES'] = "true" if stream else "false"
+    os.environ['STREAM_EDIT_INTERVAL'] = "0"
+    os.environ['LLM_MAX_CONCURRENCY'] = str(llm_concurrency)
+    os.environ['LLM_MAX_QUEUE'] = "1000000"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+
+    bot.llm_gateway.model_factory = lambda model_name: stub
+    bot.llm_gateway._models.clear()
+    return bot
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test with stubbed Telegram and Gemini.")
+    parser.add_argument("--users", default="10,100", help="comma-separated user counts")
+    parser.add_argument("--history", default="0,20,40", help="comma-separated history lengths (turns)")
+    parser.add_argument("--messages", type=int, default=5, help="messages per user per scenario")
+    parser.add_argument("--concurrency", type=int, default=100, help="users active at the same time")
+    parser.add_argument("--llm-concurrency", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.2, help="median stub model latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.5, help="log-normal sigma of the stub latency")
+    parser.add_argument("--reply-words", type=int, default=40)
+    parser.add_argument("--stream", action="store_true", help="benchmark streamed replies")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix="mahiro-bench-")
+    previous_cwd = os.getcwd()
+    os.chdir(workdir) # حتى لا يُنقل ملف user_data.json الحقيقي إن وُجد
+    try:
+        stub = StubModel(args.latency, args.jitter, args.reply_words, args.seed)
+        bot = load_bot(workdir, stub, args.stream, args.llm_concurrency)
+        logging.getLogger().setLevel(logging.WARNING)
+
+        columns = ["users", "history", "updates", "throughput", "p50_ms", "p99_ms", "llm_calls", "flush_users", "flush_ms", "flush_kb", "rewrite_ms", "rewrite_kb"]
+        if not args.json:
+            print(" ".join(f"{column:>11}" for column in columns))
+
+        async def run_all():
+            # حلقة أحداث واحدة لكل السيناريوهات لأن كائنات البوت تبقى مرتبطة بها
+            for users in (int(value) for value in args.users.split(",")):
+                for history in (int(value) for value in args.history.split(",")):
+                    result = await run_scenario(bot, stub, users, history, args.messages, args.concurrency, args.seed)
+                    if args.json:
+                        print(json.dumps(result))
+                    else:
+                        print(" ".join(f"{result[column]:>11.1f}" if isinstance(result[column], float) else f"{result[column]:>11}" for column in columns))
+
+        asyncio.run(run_all())
+        bot.user_store.close()
+    finally:
+        os.chdir(previous_cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
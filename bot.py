@@ -1,5 +1,8 @@
+import time
+STARTUP_STARTED = time.perf_counter() # لقياس زمن الإقلاع البارد
+
 import os
-import requests
+import asyncio
 import logging
 import random
 import json
@@ -7,8 +10,7 @@ import threading
 import io
 import re
 import pytz
-import time 
-from flask import Flask
+from collections import Counter
 from datetime import datetime, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
 from telegram.ext import (
@@ -22,40 +24,99 @@ from telegram.ext import (
 from telegram.constants import ChatAction
 from telegram.error import BadRequest
 
+from dispatcher import UserDispatcher
+from history import MAX_TURNS, MODEL, USER, ConversationHistory, history_of
+from intent_classifier import IntentClassifier
+from llm_gateway import (
+    BACKGROUND, INTERACTIVE, REMINDER, LLMGateway, LLMOverloaded,
+    call_site_tiers_from_env, estimate_tokens, log_llm_usage
+)
+from memory import add_summary, build_memory_context, compact_tiers
+from metrics import PROMETHEUS_CONTENT_TYPE, histogram, register_collector, render_prometheus, track_latency
+from reminders import ReminderScheduler, ReminderStore
+from response_cache import ResponseCache, cache_key, depersonalize, mentions_name, personalize
+from retrieval import ConversationIndex
+from storage import StateWriter, UserCache, UserStore
+from time_parser import parse_reminder
+
+# --- الإقلاع السريع: تأجيل الاستيرادات الثقيلة وتحميل المستخدمين عند أول رسالة ---
+FAST_START = os.getenv('FAST_START', "false").lower() == "true"
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', "5000")) # عدد المستخدمين في الذاكرة في وضع الإقلاع السريع
+
 # --- إعداد الذكاء الاصطناعي (تم التبديل إلى النموذج الأقوى) ---
-try:
-    import google.generativeai as genai
-    GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
-    if GEMINI_API_KEY:
-        genai.configure(api_key=GEMINI_API_KEY)
-        # --- التحسين: استخدام نموذج Pro بناءً على طلبك ---
-        model = genai.GenerativeModel('gemini-2.5-pro')
-    else:
-        model = None
-except ImportError:
-    model = None
-    logging.warning("مكتبة google.generativeai غير مثبتة.")
-except Exception as e:
-    model = None
-    logging.critical(f"فشل في إعداد Gemini API: {e}")
+# مكتبة google.generativeai بطيئة الاستيراد، لذا تُحمّل عند أول طلب للنموذج
+GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+genai = None
+
+def load_genai():
+    global genai
+    if genai is None:
+        import google.generativeai
+        google.generativeai.configure(api_key=GEMINI_API_KEY)
+        genai = google.generativeai
+    return genai
+
+# --- بوابة النموذج: حد للتزامن ومعدل الطلبات مع أولويات ---
+def create_model(model_name):
+    if not GEMINI_API_KEY:
+        return None
+    try:
+        return load_genai().GenerativeModel(model_name)
+    except ImportError:
+        logging.warning("مكتبة google.generativeai غير مثبتة.")
+    except Exception as e:
+        logging.critical(f"فشل في إعداد Gemini API: {e}")
+    return None
+
+llm_gateway = LLMGateway(
+    create_model,
+    call_site_tiers=call_site_tiers_from_env(),
+    max_concurrency=int(os.getenv('LLM_MAX_CONCURRENCY', "8")),
+    requests_per_minute=int(os.getenv('LLM_REQUESTS_PER_MINUTE', "0")), # 0 = بدون حد
+    tokens_per_minute=int(os.getenv('LLM_TOKENS_PER_MINUTE', "0")),
+    max_queue=int(os.getenv('LLM_MAX_QUEUE', "100"))
+)
 
 # --- إعدادات البيئة والواجهات البرمجية ---
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 
-# --- إعداد Flask للبقاء نشطاً ---
-flask_app = Flask(__name__)
-@flask_app.route("/")
-def home():
-    return "✅ Mahiro is awake, living in her digital world."
+# --- وضع النشر: "polling" (الافتراضي مع Flask والـ ping) أو "webhook" (خادم aiohttp واحد) ---
+DEPLOY_MODE = os.getenv('DEPLOY_MODE', "polling")
+WEBHOOK_URL = os.getenv('WEBHOOK_URL') # الرابط العام للخدمة، مثل https://mahiroshina.onrender.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', "telegram")
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+
+# --- المصنف المحلي للقصد (يتجاوز استدعاء النموذج في الحالات الواضحة) ---
+INTENT_CONFIDENCE_THRESHOLD = float(os.getenv('INTENT_CONFIDENCE_THRESHOLD', "0.7"))
+INTENT_MODEL_PATH = os.getenv('INTENT_MODEL_PATH') # نموذج محلي صغير اختياري
+intent_classifier = IntentClassifier(threshold=INTENT_CONFIDENCE_THRESHOLD, model_path=INTENT_MODEL_PATH)
+
+# --- وضع التوجيه: "two_stage" (طلب للقصد ثم طلب للرد) أو "single_call" (طلب واحد يرجع القصد والرد معاً) ---
+ROUTING_MODE = os.getenv('ROUTING_MODE', "two_stage")
+
+# --- إعداد Flask للبقاء نشطاً (يُستورد فقط في وضع polling) ---
+def create_flask_app():
+    from flask import Flask, Response
+
+    flask_app = Flask(__name__)
+
+    @flask_app.route("/")
+    def home():
+        return "✅ Mahiro is awake, living in her digital world."
+
+    @flask_app.route("/metrics")
+    def metrics_endpoint():
+        return Response(render_prometheus(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+    return flask_app
 
 def run_flask():
     port = int(os.environ.get("PORT", 5000))
-    flask_app.run(host="0.0.0.0", port=port)
-
-threading.Thread(target=run_flask, daemon=True).start()
+    create_flask_app().run(host="0.0.0.0", port=port)
 
 # --- إرسال طلبات دورية للحفاظ على الخدمة نشطة على Render ---
 def keep_alive_ping():
+    import requests
     while True:
         try:
             # !!! مهم: استبدل هذا الرابط بالرابط الفعلي لموقعك على Render
@@ -65,7 +126,10 @@ def keep_alive_ping():
             logger.warning(f"⚠️ Keep-alive ping failed: {e}")
         time.sleep(300) # إرسال الطلب كل 5 دقائق
 
-threading.Thread(target=keep_alive_ping, daemon=True).start()
+def start_keep_alive_threads():
+    # في وضع polling فقط؛ وضع webhook يخدم "/" من نفس الخادم غير المتزامن
+    threading.Thread(target=run_flask, daemon=True).start()
+    threading.Thread(target=keep_alive_ping, daemon=True).start()
 
 # --- إعدادات التسجيل (Logging) ---
 logging.basicConfig(
@@ -91,21 +155,39 @@ SYSTEM_INSTRUCTION_TEMPLATE = """
 مهمتك الآن هي الرد على الرسالة الأخيرة من {user_name} في سجل المحادثة، مع الحفاظ على هذه الشخصية المعقدة.
 """
 
-# --- إدارة بيانات المستخدم ---
-USER_DATA_FILE = "user_data.json"
+# رد لطيف عندما تكون البوابة مزدحمة بدلاً من فشل عشوائي
+OVERLOADED_REPLY = "...آسفة {user_name}-كن، هناك الكثير من الأحاديث حولي الآن. 🥺 هل يمكنك أن تكتب لي مرة أخرى بعد قليل؟"
 
-def load_data(filename):
-    try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
-
-def save_data(data, filename):
-    with open(filename, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
-
-user_data = load_data(USER_DATA_FILE)
+# --- إدارة بيانات المستخدم ---
+# يتم حفظ كل مستخدم في صف مستقل بقاعدة SQLite بدلاً من إعادة كتابة ملف JSON كاملاً
+USER_DATA_FILE = "user_data.json" # الملف القديم، يُنقل مرة واحدة إلى قاعدة البيانات
+USER_STATE_DB = os.getenv('USER_STATE_DB', "user_state.db")
+STATE_FLUSH_INTERVAL = float(os.getenv('STATE_FLUSH_INTERVAL', "2.0")) # نافذة تجميع الكتابات بالثواني
+
+user_store = UserStore(USER_STATE_DB)
+user_store.migrate_from_json(USER_DATA_FILE)
+if FAST_START:
+    # لا نقرأ أي مستخدم الآن؛ كل مستخدم يُحمّل عند أول رسالة ويبقى في ذاكرة LRU محدودة
+    user_data = UserCache(user_store, max_size=USER_CACHE_SIZE)
+else:
+    user_data = user_store.load_all()
+state_writer = StateWriter(user_store, user_data, flush_interval=STATE_FLUSH_INTERVAL)
+
+def is_user_pinned(user_id):
+    # لا نُخرج من الذاكرة سجلاً لم يُحفظ بعد أو تعمل عليه مهمة ما زالت تنتظر (رد أو تلخيص)،
+    # وإلا حُمّلت نسخة أخرى من القرص وضاعت تعديلات إحدى النسختين
+    return state_writer.is_dirty(user_id) or user_dispatcher.is_active(user_id) or user_id in summaries_in_progress
+
+if FAST_START:
+    user_data.is_pinned = is_user_pinned
+
+# --- فهرس الاسترجاع المحلي (BM25) على الرسائل المؤرشفة والحقائق ---
+RETRIEVAL_TOP_K = int(os.getenv('RETRIEVAL_TOP_K', "4"))
+conversation_index = ConversationIndex(user_store)
+
+def save_user(user_id):
+    # لا كتابة على القرص هنا: الكاتب الخلفي يجمع التغييرات ويحفظها دفعة واحدة
+    state_writer.mark_dirty(user_id)
 
 def get_user_data(user_id):
     return user_data.get(str(user_id), {})
@@ -115,7 +197,7 @@ def set_user_state(user_id, state=None, data=None):
     if user_id_str not in user_data:
         user_data[user_id_str] = {}
     user_data[user_id_str]['next_action'] = {'state': state, 'data': data}
-    save_data(user_data, USER_DATA_FILE)
+    save_user(user_id_str)
 
 def initialize_user_data(user_id, name):
     user_id_str = str(user_id)
@@ -123,9 +205,9 @@ def initialize_user_data(user_id, name):
         'name': name,
         'timezone': 'Asia/Riyadh', # منطقة زمنية افتراضية
         'next_action': {'state': None, 'data': None},
-        'conversation_history': [], 'memory_summary': ""
+        'conversation_history': ConversationHistory(), 'memory_tiers': {'daily': [], 'weekly': [], 'core': ""}
     }
-    save_data(user_data, USER_DATA_FILE)
+    save_user(user_id_str)
 
 # --- معالجات الأوامر والرسائل ---
 
@@ -151,7 +233,8 @@ async def help_command(update: Update, context: CallbackContext):
     أنا هنا لأساعدك وأكون صديقتك. 🌸
     """
     await update.message.reply_text(help_text)
-    
+
+@track_latency("handler_latency_seconds", "Time spent in each update handler.", handler="settings_command")
 async def settings_command(update: Update, context: CallbackContext):
     user_id = str(update.effective_user.id)
     args = context.args
@@ -168,25 +251,74 @@ async def settings_command(update: Update, context: CallbackContext):
     try:
         new_tz = pytz.timezone(args[0])
         user_data[user_id]['timezone'] = str(new_tz)
-        save_data(user_data, USER_DATA_FILE)
+        save_user(user_id)
         await update.message.reply_text(f"حسناً... لقد قمت بتحديث منطقتك الزمنية إلى {new_tz}. 💕")
     except pytz.UnknownTimeZoneError:
         await update.message.reply_text("...آسفة، لم أتعرف على هذه المنطقة الزمنية. تأكد من كتابتها بشكل صحيح (مثال: Africa/Cairo).")
 
 
+@track_latency("handler_latency_seconds", "Time spent in each update handler.", handler="handle_message")
 async def handle_message(update: Update, context: CallbackContext):
-    user_id = str(update.effective_user.id)
-    text = update.message.text if update.message.text else ""
+    # رسائل نفس المستخدم تُعالج بالترتيب، والرسائل المتتالية السريعة تُدمج في طلب واحد
+    await user_dispatcher.submit(update.effective_user.id, update, context)
+
+async def process_user_messages(batch):
+    user_id = str(batch[0][0].effective_user.id)
     user_data_local = get_user_data(user_id)
     state_info = user_data_local.get('next_action', {})
     user_state = state_info.get('state') if state_info else None
 
     if user_state == 'awaiting_name':
-        name = text.strip()
+        update, context = batch[0]
+        name = (update.message.text or "").strip()
         initialize_user_data(user_id, name)
         await update.message.reply_text(f"حسناً، {name}-كن. ...سأناديك هكذا من الآن.")
+        batch = batch[1:]
+        if not batch:
+            return
+
+    update, context = batch[-1] # نرد على آخر رسالة في الدفعة
+    text = "\n".join(u.message.text for u, _ in batch if u.message.text)
+    if len(batch) > 1:
+        logger.info(f"Merged {len(batch)} queued messages from user {user_id} into one turn")
+    await process_user_turn(update, context, text)
+
+async def report_turn_error(batch, error):
+    # نفس معالج الأخطاء العام، حتى يصل المستخدم اعتذار بدلاً من الصمت
+    update, context = batch[-1]
+    context.error = error
+    await error_handler(update, context)
+
+user_dispatcher = UserDispatcher(process_user_messages, on_error=report_turn_error)
+
+async def process_user_turn(update: Update, context: CallbackContext, text: str):
+    user_id = str(update.effective_user.id)
+
+    # --- المصنف المحلي أولاً: لا حاجة لاستدعاء النموذج إذا كان القصد واضحاً ---
+    local_result = intent_classifier.classify(text)
+    if intent_classifier.stats["total"] % 100 == 0:
+        logger.info(f"Local intent classifier hit rate: {intent_classifier.hit_rate():.1%} ({dict(intent_classifier.stats)})")
+
+    if local_result.confidence >= intent_classifier.threshold:
+        intent, data = local_result.intent, local_result.data
+    elif ROUTING_MODE == "single_call":
+        await route_and_reply(update, context, text)
         return
+    else:
+        intent, data = await route_intent_with_llm(text)
+
+    # --- توجيه الطلب بناءً على القصد ---
+    if intent == "reminder":
+        await handle_smart_reminder(update, context, data)
+    elif intent == "search":
+        await handle_search(update, context, data)
+    elif intent == "remember_fact":
+        await remember_fact(user_id, data)
+        await respond_to_conversation(update, context, text_input=data)
+    else: # الافتراضي هو المحادثة
+        await respond_to_conversation(update, context, text_input=data)
 
+async def route_intent_with_llm(text):
     # --- العقل الموجه (Intent Router) ---
     intent_prompt = f"""
     حلل الرسالة التالية من المستخدم: '{text}'.
@@ -199,7 +331,7 @@ async def handle_message(update: Update, context: CallbackContext):
     """
     
     try:
-        response = await model.generate_content_async(intent_prompt)
+        response = await llm_gateway.generate(intent_prompt, call_site="intent", priority=INTERACTIVE)
         json_text = response.text.strip().replace("```json", "").replace("```", "")
         intent_data = json.loads(json_text)
         intent = intent_data.get("intent")
@@ -208,46 +340,21 @@ async def handle_message(update: Update, context: CallbackContext):
         logger.error(f"Intent parsing error: {e}")
         intent = "conversation"
         data = text
+    return intent, data
 
-    # --- توجيه الطلب بناءً على القصد ---
-    if intent == "reminder":
-        await handle_smart_reminder(update, context, data)
-    elif intent == "search":
-        await respond_to_conversation(update, context, text_input=f"ابحثي لي في الإنترنت عن '{data}' وقدمي لي ملخصاً بأسلوبك.")
-    else: # الافتراضي هو المحادثة
-        await respond_to_conversation(update, context, text_input=data)
-
+@track_latency("handler_latency_seconds", "Time spent in each update handler.", handler="respond_to_conversation")
 async def respond_to_conversation(update: Update, context: CallbackContext, text_input=None, audio_input=None):
     user_id = str(update.effective_user.id)
     user_name = get_user_data(user_id).get('name', 'أماني-كن')
 
-    if not model:
+    if not llm_gateway.get_model():
         await update.message.reply_text(f"💔 آسفة {user_name}-كن، لا أستطيع التفكير الآن.")
         return
 
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
     
     try:
-        history_list = get_user_data(user_id).get('conversation_history', [])
-        memory_summary = get_user_data(user_id).get('memory_summary', "")
-        
-        if len(history_list) > 20:
-            summary_prompt = f"لخص المحادثة التالية في نقاط أساسية للحفاظ عليها في الذاكرة طويلة الأمد:\n\n{json.dumps(history_list[:10])}"
-            summary_response = await model.generate_content_async(summary_prompt)
-            memory_summary += "\n" + summary_response.text
-            history_list = history_list[10:]
-            user_data[str(user_id)]['memory_summary'] = memory_summary
-        
-        memory = get_user_data(user_id).get('memory', {})
-        memory_context = f"ملخص محادثاتنا السابقة:\n{memory_summary}\n\nأشياء أعرفها عنك:\n" + "\n".join(f"- {k}: {v}" for k, v in memory.items())
-        
-        system_instruction = SYSTEM_INSTRUCTION_TEMPLATE.format(user_name=user_name, memory_context=memory_context)
-        
-        chat_history_for_api = [
-            {'role': 'user', 'parts': [system_instruction]},
-            {'role': 'model', 'parts': ["...حسناً، فهمت. سأتحدث مع {user_name}-كن الآن.".format(user_name=user_name)]}
-        ]
-        chat_history_for_api.extend(history_list)
+        history = load_conversation_history(user_id)
         
         new_message_parts = []
         if text_input: new_message_parts.append(text_input)
@@ -255,57 +362,406 @@ async def respond_to_conversation(update: Update, context: CallbackContext, text
             new_message_parts.append(audio_input)
             if not text_input: new_message_parts.insert(0, "صديقي أرسل لي هذا المقطع الصوتي، استمعي إليه وردي عليه.")
         
-        chat_history_for_api.append({'role': 'user', 'parts': new_message_parts})
+        snippets = await conversation_index.search(user_id, text_input, RETRIEVAL_TOP_K)
+        chat_history_for_api = build_chat_history_for_api(user_id, user_name, history, new_message_parts, snippets)
 
-        response = await model.generate_content_async(chat_history_for_api)
-        response_text = response.text
+        if STREAM_REPLIES:
+            response_text = await stream_reply(update, chat_history_for_api)
+        else:
+            response = await llm_gateway.generate(chat_history_for_api, call_site="conversation", priority=INTERACTIVE)
+            response_text = response.text
         
-        history_list.append({'role': 'user', 'parts': [text_input if text_input else "رسالة صوتية"]})
-        history_list.append({'role': 'model', 'parts': [response_text]})
-        user_data[str(user_id)]['conversation_history'] = history_list[-20:]
+        remember_turn(user_id, text_input if text_input else "رسالة صوتية", response_text)
         
-        await update.message.reply_text(response_text)
+        if not STREAM_REPLIES:
+            await update.message.reply_text(response_text)
+        schedule_memory_summary(context, user_id)
     
+    except LLMOverloaded as e:
+        logger.warning(f"Conversation request shed: {e}")
+        await update.message.reply_text(OVERLOADED_REPLY.format(user_name=user_name))
     except Exception as e:
         logger.error(f"Gemini API error: {e}")
         await update.message.reply_text(f"...آسفة {user_name}-كن، عقلي مشوش قليلاً الآن.")
     finally:
-        save_data(user_data, USER_DATA_FILE)
+        save_user(user_id)
+
+# --- الرد المتدفق: إرسال أول جزء فوراً ثم تعديل الرسالة تدريجياً ---
+STREAM_REPLIES = os.getenv('STREAM_REPLIES', "false").lower() == "true"
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', "1.5")) # أقل فاصل بين تعديلين (حدود تيليجرام)
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+time_to_first_token = histogram("llm_time_to_first_token_seconds", "Time until the first streamed chunk of a reply arrives")
+
+async def stream_reply(update: Update, chat_history_for_api):
+    async with llm_gateway.slot(INTERACTIVE, estimate_tokens(chat_history_for_api)):
+        return await consume_stream(update, chat_history_for_api)
+
+async def consume_stream(update: Update, chat_history_for_api):
+    started = time.perf_counter()
+    response = await llm_gateway.model_for("conversation").generate_content_async(chat_history_for_api, stream=True)
+
+    text = ""
+    message = None
+    shown = ""
+    offset = 0 # بداية النص المعروض في الرسالة الحالية (للردود الأطول من حد تيليجرام)
+    last_edit = 0.0
+    first_chunk_at = None
+
+    async def show():
+        nonlocal message, shown, offset, last_edit
+        while len(text) - offset > TELEGRAM_MESSAGE_LIMIT:
+            part = text[offset:offset + TELEGRAM_MESSAGE_LIMIT]
+            if message is None:
+                await update.message.reply_text(part)
+            elif part != shown:
+                await edit_stream_message(message, part)
+            offset += TELEGRAM_MESSAGE_LIMIT
+            message, shown = None, ""
+        part = text[offset:]
+        if message is None:
+            message = await update.message.reply_text(part)
+        elif part != shown:
+            await edit_stream_message(message, part)
+        shown = part
+        last_edit = time.perf_counter()
+
+    async for chunk in response:
+        piece = getattr(chunk, 'text', "")
+        if not piece:
+            continue
+        text += piece
+        if first_chunk_at is None:
+            first_chunk_at = time.perf_counter()
+            time_to_first_token.observe(first_chunk_at - started)
+            logger.info(f"Time to first token: {first_chunk_at - started:.2f}s")
+            await show()
+        elif time.perf_counter() - last_edit >= STREAM_EDIT_INTERVAL:
+            await show()
+
+    if not text:
+        raise ValueError("Empty streamed reply")
+    if text[offset:] != shown:
+        await show()
+    log_llm_usage("conversation_stream", response, started)
+    return text
+
+async def edit_stream_message(message, text):
+    try:
+        await message.edit_text(text)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+
+def load_conversation_history(user_id):
+    return history_of(get_user_data(user_id))
+
+# --- تلخيص الذاكرة في الخلفية (خارج مسار الرد) ---
+HISTORY_SUMMARY_TRIGGER = 20 # عدد الرسائل التي يبدأ بعدها التلخيص
+HISTORY_SUMMARY_BATCH = 10 # عدد أقدم الرسائل التي تُلخص في كل مرة
+HISTORY_HARD_LIMIT = MAX_TURNS # حد أقصى في حال تأخر التلخيص (HISTORY_MAX_TURNS و HISTORY_MAX_BYTES)
+MEMORY_BUDGET_BYTES = int(os.getenv('MEMORY_BUDGET_BYTES', "8000")) # الحد الأقصى لحجم الذاكرة داخل التعليمات
+
+summaries_in_progress = set()
+
+def schedule_memory_summary(context: CallbackContext, user_id):
+    user_id = str(user_id)
+    if len(load_conversation_history(user_id)) <= HISTORY_SUMMARY_TRIGGER or user_id in summaries_in_progress:
+        return
+    summaries_in_progress.add(user_id)
+    context.application.create_task(summarize_user_memory(user_id))
+
+async def summarize_user_memory(user_id):
+    try:
+        batch = load_conversation_history(user_id).oldest(HISTORY_SUMMARY_BATCH)
+        summary_prompt = f"لخص المحادثة التالية في نقاط أساسية للحفاظ عليها في الذاكرة طويلة الأمد:\n\n{json.dumps(batch, ensure_ascii=False)}"
+        summary_response = await llm_gateway.generate(summary_prompt, call_site="summarization", priority=BACKGROUND)
+
+        # الاستبدال يتم دفعة واحدة بدون أي await حتى لا يرى الرد سجلاً نصف محدث
+        record = user_data.get(user_id)
+        if record is None:
+            return
+        history = history_of(record)
+        # الرسائل الجديدة أثناء التلخيص قد تُسقط أقدم رسائل الدفعة (وقد أرشفها remember_turn)،
+        # فنحذف فقط ما بقي منها في بداية السجل والملخص يغطي الدفعة كلها
+        remaining = batch[len(batch) - still_present_prefix(history, batch):]
+        add_summary(record, summary_response.text, user_today(user_id))
+        history.drop_oldest(len(remaining))
+        save_user(user_id)
+
+        # أرشفة الرسائل الملخصة في فهرس الاسترجاع حتى لا تضيع تفاصيلها
+        user_name = record.get('name', 'أماني-كن')
+        await conversation_index.archive(user_id, "turn", [format_archived_turn(user_name, turn) for turn in remaining])
+
+        # ضغط الطبقات الأقدم إذا تجاوزت الذاكرة ميزانيتها
+        await compact_tiers(record, MEMORY_BUDGET_BYTES, summarize_for_memory)
+        save_user(user_id)
+    except Exception as e:
+        logger.error(f"Background summarization failed for user {user_id}: {e}")
+    finally:
+        summaries_in_progress.discard(user_id)
+
+def still_present_prefix(history, batch):
+    """How many of the batch's newest turns still open the history (0 if none)."""
+    for skipped in range(len(batch) + 1):
+        kept = batch[skipped:]
+        if history.oldest(len(kept)) == kept:
+            return len(kept)
+    return 0
+
+def format_archived_turn(user_name, turn):
+    role, text = turn
+    speaker = user_name if role == USER else "ماهيرو"
+    return f"{speaker}: {text}"
+
+async def remember_fact(user_id, fact):
+    record = user_data[str(user_id)]
+    memory = record.setdefault('memory', {})
+    memory[str(len(memory) + 1)] = fact
+    save_user(user_id)
+    await conversation_index.archive(user_id, "fact", [fact])
+
+async def summarize_for_memory(prompt):
+    response = await llm_gateway.generate(prompt, call_site="memory_compaction", priority=BACKGROUND)
+    return response.text
+
+def user_today(user_id):
+    user_tz = pytz.timezone(get_user_data(user_id).get('timezone', 'Asia/Riyadh'))
+    return datetime.now(user_tz).date()
+
+def build_chat_history_for_api(user_id, user_name, history, new_message_parts, snippets=None):
+    # الشكل الذي تتوقعه واجهة Gemini يُبنى هنا فقط، عند إرسال الطلب فعلاً
+    memory_context = build_memory_context(user_data[str(user_id)], MEMORY_BUDGET_BYTES, snippets)
+    
+    system_instruction = SYSTEM_INSTRUCTION_TEMPLATE.format(user_name=user_name, memory_context=memory_context)
+    
+    chat_history_for_api = [
+        {'role': 'user', 'parts': [system_instruction]},
+        {'role': 'model', 'parts': ["...حسناً، فهمت. سأتحدث مع {user_name}-كن الآن.".format(user_name=user_name)]}
+    ]
+    chat_history_for_api.extend(history.to_api())
+    chat_history_for_api.append({'role': 'user', 'parts': new_message_parts})
+
+    prompt_bytes = sum(len(part.encode('utf-8')) for turn in chat_history_for_api for part in turn['parts'] if isinstance(part, str))
+    logger.info(f"Prompt for user {user_id}: {prompt_bytes} bytes (memory {len(memory_context.encode('utf-8'))} bytes, {len(history)} turns)")
+    return chat_history_for_api
+
+def remember_turn(user_id, user_text, response_text):
+    # نضيف إلى السجل الحالي وليس إلى النسخة التي قرأناها، فقد يكون التلخيص الخلفي غيّره أثناء انتظار الرد
+    record = user_data[str(user_id)]
+    history = history_of(record)
+    # الحلقة تُسقط الأقدم تلقائياً عند تجاوز HISTORY_HARD_LIMIT أو حد البايتات، فنؤرشف ما سقط حتى لا يضيع
+    dropped = history.append(USER, user_text) + history.append(MODEL, response_text)
+    if dropped:
+        user_name = record.get('name', 'أماني-كن')
+        asyncio.ensure_future(conversation_index.archive(str(user_id), "turn", [format_archived_turn(user_name, turn) for turn in dropped]))
+
+# --- ذاكرة مؤقتة لإجابات البحث: نفس السؤال من مستخدمين مختلفين لا يكلف طلباً جديداً ---
+SEARCH_PROMPT = "ابحثي لي في الإنترنت عن '{query}' وقدمي لي ملخصاً بأسلوبك."
+search_cache = ResponseCache(
+    ttl=float(os.getenv('SEARCH_CACHE_TTL', "21600")), # 6 ساعات
+    max_entries=int(os.getenv('SEARCH_CACHE_MAX_ENTRIES', "1000")),
+    max_bytes=int(os.getenv('SEARCH_CACHE_MAX_BYTES', str(4 * 1024 * 1024))),
+    path=os.getenv('SEARCH_CACHE_PATH') or None # اختياري: ملف JSON يبقى بعد إعادة التشغيل
+)
+searches_in_flight = {} # نفس السؤال أثناء انتظار إجابته ينتظر الطلب نفسه
+
+async def handle_search(update: Update, context: CallbackContext, query: str):
+    user_id = str(update.effective_user.id)
+    user_name = get_user_data(user_id).get('name', 'أماني-كن')
+    prompt = SEARCH_PROMPT.format(query=query)
+    key = cache_key("search", query)
+    if key is None or not llm_gateway.get_model():
+        await respond_to_conversation(update, context, text_input=prompt)
+        return
+
+    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
+    try:
+        cached = search_cache.get(key)
+        if cached is None:
+            pending = searches_in_flight.get(key)
+            owner = pending is None
+            if owner:
+                pending = searches_in_flight[key] = asyncio.ensure_future(generate_search_answer(key, prompt, user_name))
+                pending.add_done_callback(lambda _: searches_in_flight.pop(key, None))
+            else:
+                search_cache.stats["coalesced"] += 1
+            cached, shareable = await asyncio.shield(pending)
+            if not shareable and not owner:
+                # إجابة صاحب الطلب الأول تحمل اسمه، فنولد إجابة خاصة بهذا المستخدم
+                cached, _ = await generate_search_answer(key, prompt, user_name)
+        response_text = personalize(cached, user_name)
+    except LLMOverloaded as e:
+        logger.warning(f"Search request shed: {e}")
+        await update.message.reply_text(OVERLOADED_REPLY.format(user_name=user_name))
+        return
+    except Exception as e:
+        logger.error(f"Search answer error: {e}")
+        await update.message.reply_text(f"...آسفة {user_name}-كن، عقلي مشوش قليلاً الآن.")
+        return
+
+    remember_turn(user_id, prompt, response_text)
+    save_user(user_id)
+    await update.message.reply_text(response_text)
+    schedule_memory_summary(context, user_id)
+
+async def generate_search_answer(key, prompt, user_name):
+    # بدون سجل المحادثة أو الذاكرة حتى تصلح الإجابة لأي مستخدم ولا تكشف شيئاً عن صاحبها
+    contents = [
+        {'role': 'user', 'parts': [SYSTEM_INSTRUCTION_TEMPLATE.format(user_name=user_name, memory_context="")]},
+        {'role': 'model', 'parts': [f"...حسناً، فهمت. سأتحدث مع {user_name}-كن الآن."]},
+        {'role': 'user', 'parts': [prompt]}
+    ]
+    response = await llm_gateway.generate(contents, call_site="search", priority=INTERACTIVE)
+    answer = depersonalize(response.text, user_name)
+    # إذا بقي الاسم في الإجابة بشكل لم نتعرف عليه فلا نخزنها حتى لا تصل لمستخدم آخر
+    shareable = not mentions_name(answer, user_name)
+    if shareable:
+        search_cache.put(key, answer)
+    return answer, shareable
+
+# --- وضع الاستدعاء الواحد: توجيه القصد والرد في طلب واحد ---
+ROUTE_AND_REPLY_INSTRUCTION = """
+{text}
+
+(تعليمات داخلية: قبل الرد، حددي "قصد" الرسالة السابقة من بين: [conversation, search, reminder, remember_fact].
+أرجعي الرد فقط على شكل JSON: {{"intent": "اسم_القصد", "data": "البيانات_المستخرجة_من_النص", "reply": "ردك على الرسالة بشخصيتك"}}.
+اكتبي "reply" فقط إذا كان القصد conversation أو remember_fact، واتركيه فارغاً في غير ذلك.)
+"""
+
+async def route_and_reply(update: Update, context: CallbackContext, text: str):
+    user_id = str(update.effective_user.id)
+    user_name = get_user_data(user_id).get('name', 'أماني-كن')
+
+    if not llm_gateway.get_model():
+        await update.message.reply_text(f"💔 آسفة {user_name}-كن، لا أستطيع التفكير الآن.")
+        return
+
+    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
+
+    try:
+        history = load_conversation_history(user_id)
+        snippets = await conversation_index.search(user_id, text, RETRIEVAL_TOP_K)
+        chat_history_for_api = build_chat_history_for_api(
+            user_id, user_name, history, [ROUTE_AND_REPLY_INSTRUCTION.format(text=text)], snippets
+        )
+        response = await llm_gateway.generate(
+            chat_history_for_api,
+            call_site="route_and_reply",
+            priority=INTERACTIVE,
+            generation_config={"response_mime_type": "application/json"}
+        )
+        result = json.loads(response.text.strip().replace("```json", "").replace("```", ""))
+        intent = result.get("intent")
+        data = result.get("data") or text
+        reply = result.get("reply")
+    except LLMOverloaded as e:
+        logger.warning(f"Single-call request shed: {e}")
+        await update.message.reply_text(OVERLOADED_REPLY.format(user_name=user_name))
+        return
+    except Exception as e:
+        logger.error(f"Single-call routing error, falling back to two-stage reply: {e}")
+        await respond_to_conversation(update, context, text_input=text)
+        return
+
+    if intent == "reminder":
+        await handle_smart_reminder(update, context, data)
+    elif intent == "search":
+        await handle_search(update, context, data)
+    elif reply:
+        if intent == "remember_fact":
+            await remember_fact(user_id, data)
+        remember_turn(user_id, text, reply)
+        save_user(user_id)
+        await update.message.reply_text(reply)
+        schedule_memory_summary(context, user_id)
+    else:
+        await respond_to_conversation(update, context, text_input=data)
 
 # --- نظام التذكيرات ---
 async def reminder_callback(context: CallbackContext):
     job = context.job
     await context.bot.send_message(chat_id=job.chat_id, text=f"⏰ ...تذكير، {job.data['user_name']}-كن. لقد طلبت مني أن أذكرك بـ: '{job.data['task']}'")
 
+# التذكيرات محفوظة في قاعدة بيانات حتى لا تضيع عند إعادة التشغيل
+REMINDERS_DB = os.getenv('REMINDERS_DB', "reminders.db")
+reminder_scheduler = ReminderScheduler(
+    ReminderStore(REMINDERS_DB),
+    reminder_callback,
+    horizon=float(os.getenv('REMINDER_HORIZON_SECONDS', "300")),
+    batch_size=int(os.getenv('REMINDER_BATCH_SIZE', "100")),
+    max_per_second=int(os.getenv('REMINDER_SENDS_PER_SECOND', "25"))
+)
+
+reminder_parser_stats = Counter() # كم تذكيراً فهمه المحلل المحلي وكم احتاج إلى النموذج
+
+@track_latency("handler_latency_seconds", "Time spent in each update handler.", handler="handle_smart_reminder")
 async def handle_smart_reminder(update: Update, context: CallbackContext, text: str):
     user_id = str(update.effective_user.id)
     user_name = get_user_data(user_id).get('name', 'أماني-كن')
     user_tz_str = get_user_data(user_id).get('timezone', 'Asia/Riyadh')
     user_tz = pytz.timezone(user_tz_str)
-    current_time_user = datetime.now(user_tz).strftime("%Y-%m-%d %H:%M:%S")
 
-    await update.message.reply_text("حسناً... سأحاول أن أفهم هذا التذكير.")
-    
     try:
-        prompt = f"التوقيت الحالي لدى صديقي هو '{current_time_user}' في منطقته الزمنية. لقد طلب مني تذكيره بهذا: '{text}'. حللي النص بدقة واستخرجي 'ماذا يجب أن أذكره به' و'متى' بالثواني من الآن. أرجعي الرد فقط على شكل JSON صالح للاستخدام البرمجي: {{\"task\": \"النص\", \"delay_seconds\": عدد_الثواني}}. إذا لم تستطيعي تحديد الوقت، اجعلي delay_seconds صفراً."
-        response = await model.generate_content_async(prompt)
-        
-        json_text = response.text.strip().replace("```json", "").replace("```", "")
-        reminder_data = json.loads(json_text)
-        
-        task = reminder_data.get("task")
-        delay = reminder_data.get("delay_seconds")
-
-        if task and isinstance(delay, int) and delay > 0:
-            context.job_queue.run_once(reminder_callback, delay, chat_id=user_id, name=f"reminder_{user_id}_{task}", data={'task': task, 'user_name': user_name})
+        # المحلل المحلي أولاً؛ النموذج فقط للعبارات التي لا يفهمها
+        local_result = parse_reminder(text, user_tz)
+        if local_result:
+            reminder_parser_stats["local"] += 1
+            task, delay = local_result
+        else:
+            reminder_parser_stats["llm"] += 1
+            await update.message.reply_text("حسناً... سأحاول أن أفهم هذا التذكير.")
+            current_time_user = datetime.now(user_tz).strftime("%Y-%m-%d %H:%M:%S")
+            prompt = f"التوقيت الحالي لدى صديقي هو '{current_time_user}' في منطقته الزمنية. لقد طلب مني تذكيره بهذا: '{text}'. حللي النص بدقة واستخرجي 'ماذا يجب أن أذكره به' و'متى' بالثواني من الآن. أرجعي الرد فقط على شكل JSON صالح للاستخدام البرمجي: {{\"task\": \"النص\", \"delay_seconds\": عدد_الثواني}}. إذا لم تستطيعي تحديد الوقت، اجعلي delay_seconds صفراً."
+            response = await llm_gateway.generate(prompt, call_site="reminder_parsing", priority=REMINDER)
+            
+            json_text = response.text.strip().replace("```json", "").replace("```", "")
+            reminder_data = json.loads(json_text)
+            
+            task = reminder_data.get("task")
+            try:
+                delay = int(float(reminder_data.get("delay_seconds")))
+            except (TypeError, ValueError):
+                delay = 0
+
+        if task and delay > 0:
+            await reminder_scheduler.schedule(user_id, delay, {'task': task, 'user_name': user_name})
             await update.message.reply_text(f"حسناً، سأذكرك بـ '{task}' بعد {timedelta(seconds=delay)}.")
         else:
             await update.message.reply_text("...آسفة، لم أفهم الوقت المحدد في طلبك. لتذكير دقيق، جرب استخدام الأمر /settings لضبط منطقتك الزمنية أولاً.")
 
+    except LLMOverloaded as e:
+        logger.warning(f"Reminder parsing request shed: {e}")
+        await update.message.reply_text(OVERLOADED_REPLY.format(user_name=user_name))
     except Exception as e:
         logger.error(f"Smart reminder parsing error: {e}")
         await update.message.reply_text("...آسفة، واجهتني مشكلة في فهم هذا التذكير.")
 
+# --- المقاييس: أعماق الطوابير والعدادات تُقرأ لحظة طلب /metrics ---
+register_collector("queue_depth", "Items waiting in each in-process queue.", "gauge", lambda: [
+    ({"queue": "dispatcher"}, user_dispatcher.depth),
+    ({"queue": "llm_gateway"}, llm_gateway.queue_depth),
+    ({"queue": "state_writer"}, state_writer.pending),
+    ({"queue": "reminder_scheduler"}, reminder_scheduler.depth),
+])
+register_collector("dispatcher_active_users", "Users with a turn in flight.", "gauge", lambda: [({}, user_dispatcher.active_users)])
+register_collector("llm_running_requests", "LLM requests currently holding a gateway slot.", "gauge", lambda: [({}, llm_gateway.running)])
+register_collector("llm_shed_total", "LLM requests shed by the gateway.", "counter", lambda: [({}, llm_gateway.shed)])
+register_collector("llm_answered_total", "LLM answers by call site and model tier.", "counter", lambda: [
+    ({"call_site": call_site, "tier": tier}, count) for (call_site, tier), count in sorted(llm_gateway.answered_by.items())
+])
+register_collector("intent_classifier_total", "Intent classifier outcomes.", "counter", lambda: [
+    ({"outcome": outcome}, count) for outcome, count in sorted(intent_classifier.stats.items())
+])
+register_collector("search_cache_total", "Search answer cache lookups, evictions and coalesced requests.", "counter", lambda: [
+    ({"result": result}, count) for result, count in sorted(search_cache.stats.items())
+])
+register_collector("search_cache_entries", "Answers held in the search cache.", "gauge", lambda: [({}, len(search_cache))])
+register_collector("search_cache_bytes", "Text bytes held in the search cache.", "gauge", lambda: [({}, search_cache.nbytes)])
+register_collector("reminder_parser_total", "Reminders parsed locally versus by the LLM.", "counter", lambda: [
+    ({"parser": parser}, count) for parser, count in sorted(reminder_parser_stats.items())
+])
+
 # --- نظام الأمان: معالج الأخطاء ---
 async def error_handler(update: object, context: CallbackContext) -> None:
     logger.error("Exception while handling an update:", exc_info=context.error)
@@ -319,12 +775,40 @@ async def error_handler(update: object, context: CallbackContext) -> None:
             logger.error(f"Failed to send error message to user: {e}")
 
 # --- تشغيل البوت ---
-def main():
-    if not TELEGRAM_TOKEN or not GEMINI_API_KEY:
-        logger.critical("خطأ فادح: متغيرات البيئة TELEGRAM_TOKEN و GEMINI_API_KEY مطلوبة.")
-        return
-
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+IMPORT_SECONDS = time.perf_counter() - STARTUP_STARTED
+startup_seconds = 0.0
+register_collector("startup_seconds", "Seconds from importing bot.py until the bot was ready.", "gauge", lambda: [
+    ({"phase": "import"}, IMPORT_SECONDS), ({"phase": "ready"}, startup_seconds)
+])
+
+async def on_startup(application: Application):
+    global startup_seconds
+    state_writer.start()
+    reminder_scheduler.start(application)
+    startup_seconds = time.perf_counter() - STARTUP_STARTED
+    logger.info(
+        f"Startup took {startup_seconds:.2f}s (imports and setup {IMPORT_SECONDS:.2f}s, "
+        f"fast start {'on' if FAST_START else 'off'}, {len(user_data)} users in memory)"
+    )
+
+async def on_shutdown(application: Application):
+    await reminder_scheduler.stop()
+    await state_writer.stop()
+    search_cache.save()
+    if search_cache.path:
+        logger.info(f"Search cache saved ({len(search_cache)} answers, hit rate {search_cache.hit_rate():.1%})")
+
+def build_application(token, use_updater=True):
+    builder = (
+        Application.builder()
+        .token(token)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .concurrent_updates(True) # الترتيب لكل مستخدم يضمنه user_dispatcher
+    )
+    if not use_updater:
+        builder = builder.updater(None) # التحديثات تصل عبر الـ webhook الخاص بنا
+    application = builder.build()
 
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("help", help_command))
@@ -332,7 +816,31 @@ def main():
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     
     application.add_error_handler(error_handler)
-    
+    return application
+
+def main():
+    if not TELEGRAM_TOKEN or not GEMINI_API_KEY:
+        logger.critical("خطأ فادح: متغيرات البيئة TELEGRAM_TOKEN و GEMINI_API_KEY مطلوبة.")
+        return
+
+    if DEPLOY_MODE == "webhook":
+        from webhook_server import run_webhook # يحتاج aiohttp، فلا يُستورد في وضع polling
+        application = build_application(TELEGRAM_TOKEN, use_updater=False)
+        logger.info("🌸 Mahiro is running in webhook mode!")
+        asyncio.run(run_webhook(
+            application,
+            host=os.getenv('WEBHOOK_HOST', "0.0.0.0"), # عمال sharding.py يستمعون على 127.0.0.1 فقط
+            port=int(os.environ.get("PORT", 5000)),
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            on_startup=on_startup,
+            on_shutdown=on_shutdown
+        ))
+        return
+
+    start_keep_alive_threads()
+    application = build_application(TELEGRAM_TOKEN)
     logger.info("🌸 Mahiro (Final Optimized Edition with Timezone) is running!")
     application.run_polling()
 
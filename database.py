@@ -1,19 +1,125 @@
 import sqlite3
+import asyncio
 import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+import json
+import time
 import uuid # تأكد من وجود هذا الاستيراد هنا
 
+from metrics import counter, histogram, track_latency
+
 logger = logging.getLogger(__name__)
 
 DATABASE_NAME = "bot_data.db"
 
-def init_db():
-    """Initializes the database by creating necessary tables if they don't exist,
-    and adds new columns if they are missing."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
+# --- إعدادات الاتصال: اتصالات دائمة بوضع WAL على مجموعة خيوط صغيرة ---
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', "4"))
+DB_SYNCHRONOUS = os.getenv('DB_SYNCHRONOUS', "NORMAL").upper() # OFF | NORMAL | FULL | EXTRA
+DB_BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS', "5000"))
+DB_STATEMENT_CACHE_SIZE = 256
+
+# --- تجميع آخر نشاط لكل مستخدم في الذاكرة وكتابته دفعة واحدة ---
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv('DB_ACTIVITY_FLUSH_INTERVAL', "30"))
+ACTIVITY_FLUSH_SIZE = int(os.getenv('DB_ACTIVITY_FLUSH_SIZE', "1000"))
+
+# --- عدد الأيام التي نحتفظ فيها بقائمة المستخدمين النشطين لكل يوم (لنوافذ الإحصائيات المتحركة) ---
+STATS_ACTIVE_RETENTION_DAYS = int(os.getenv('DB_STATS_ACTIVE_RETENTION_DAYS', "35"))
+
+def timed_query(func):
+    """Records the duration of a query function under its name in /metrics."""
+    return track_latency("db_query_seconds", "Duration of database.py queries.", query=func.__name__)(func)
+
+
+class ConnectionPool:
+    """Runs queries on a small thread pool, each thread with its own long-lived connection.
+
+    Connections are opened once per worker thread in WAL mode, so readers do
+    not block the writer, and keep sqlite3's prepared-statement cache warm
+    across calls. ``run`` awaits the query in the executor, so callers yield
+    to the event loop instead of blocking it.
+    """
+
+    def __init__(self, path: str, size: int = DB_POOL_SIZE, synchronous: str = DB_SYNCHRONOUS,
+                 busy_timeout_ms: int = DB_BUSY_TIMEOUT_MS):
+        if synchronous not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+            raise ValueError(f"Invalid DB_SYNCHRONOUS value: {synchronous}")
+        self.path = path
+        self.synchronous = synchronous
+        self.busy_timeout_ms = busy_timeout_ms
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="db")
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.path,
+                timeout=self.busy_timeout_ms / 1000,
+                check_same_thread=False,
+                cached_statements=DB_STATEMENT_CACHE_SIZE
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={self.synchronous}")
+            conn.execute(f"PRAGMA busy_timeout={self.busy_timeout_ms}")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _call(self, func, args):
+        return func(self._connection(), *args)
+
+    async def run(self, func, *args):
+        """Runs ``func(conn, *args)`` on a pool thread and returns its result."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._call, func, args)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
 
-    # Create users table if it doesn't exist
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool() -> ConnectionPool:
+    """Returns the shared pool for DATABASE_NAME, creating it on first use."""
+    global _pool
+    if _pool is None or _pool.path != DATABASE_NAME:
+        with _pool_lock:
+            if _pool is None or _pool.path != DATABASE_NAME:
+                if _pool is not None:
+                    _pool.close()
+                _pool = ConnectionPool(DATABASE_NAME)
+    return _pool
+
+async def shutdown_db():
+    """Flushes the buffered activity, then closes the pooled connections."""
+    await activity_buffer.stop()
+    close_db()
+
+def close_db():
+    """Closes the pooled connections (call on shutdown)."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+# --- الترحيلات: كل دالة ترفع المخطط نسخة واحدة، ورقم النسخة محفوظ في PRAGMA user_version ---
+def _columns(cursor, table: str) -> set:
+    return {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+
+def _migration_base_schema(cursor):
+    """Creates the users, pending_payments and purchases_history tables."""
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
@@ -24,24 +130,13 @@ def init_db():
         )
     """)
 
-    # Add last_activity column if it doesn't exist
-    try:
-        cursor.execute("SELECT last_activity FROM users LIMIT 1")
-    except sqlite3.OperationalError:
-        cursor.execute("ALTER TABLE users ADD COLUMN last_activity TEXT") # لا نحدد قيمة افتراضية هنا
-        cursor.execute("UPDATE users SET last_activity = CURRENT_TIMESTAMP WHERE last_activity IS NULL") # نحدث الموجودين
-        logger.info("Added and initialized 'last_activity' column to 'users' table.")
-    
-    # Add created_at column if it doesn't exist
-    try:
-        cursor.execute("SELECT created_at FROM users LIMIT 1")
-    except sqlite3.OperationalError:
-        cursor.execute("ALTER TABLE users ADD COLUMN created_at TEXT") # لا نحدد قيمة افتراضية هنا
-        cursor.execute("UPDATE users SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL") # نحدث الموجودين
-        logger.info("Added and initialized 'created_at' column to 'users' table.")
-
+    # قواعد البيانات الأقدم من تتبع النسخ قد تفتقد هذين العمودين
+    for column in ("last_activity", "created_at"):
+        if column not in _columns(cursor, "users"):
+            cursor.execute(f"ALTER TABLE users ADD COLUMN {column} TEXT") # لا نحدد قيمة افتراضية هنا
+            cursor.execute(f"UPDATE users SET {column} = CURRENT_TIMESTAMP WHERE {column} IS NULL") # نحدث الموجودين
+            logger.info(f"Added and initialized '{column}' column to 'users' table.")
 
-    # Pending payments table
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS pending_payments (
             payment_id TEXT PRIMARY KEY,
@@ -55,7 +150,6 @@ def init_db():
         )
     """)
 
-    # Purchases history table
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS purchases_history (
             purchase_id TEXT PRIMARY KEY,
@@ -69,190 +163,497 @@ def init_db():
             shipped_at TEXT
         )
     """)
-    
-    conn.commit()
-    conn.close()
-    logger.info("Database initialized successfully.")
 
-async def get_user_wallet_db(user_id: int) -> float:
-    """Fetches the user's wallet balance from the database."""
-    conn = sqlite3.connect(DATABASE_NAME)
+def _migration_wallet_ledger(cursor):
+    """Adds the append-only ledger of every wallet change."""
+    ledger_exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'wallet_ledger'").fetchone()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS wallet_ledger (
+            entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            balance_after REAL NOT NULL,
+            reason TEXT,
+            reference TEXT,
+            created_at TEXT
+        )
+    """)
+    if not ledger_exists:
+        # الأرصدة الموجودة قبل الدفتر تُسجل كرصيد افتتاحي حتى تتطابق المراجعة
+        cursor.execute("""
+            INSERT INTO wallet_ledger (user_id, amount, balance_after, reason, created_at)
+            SELECT user_id, balance, balance, 'opening_balance', ? FROM users WHERE balance != 0
+        """, (datetime.now().isoformat(),))
+        logger.info(f"Created 'wallet_ledger' table with {cursor.rowcount} opening balances.")
+
+def _migration_query_indexes(cursor):
+    """Adds covering indexes for the per-user, per-status and per-date queries."""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_purchases_user_time ON purchases_history (user_id, timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_purchases_user_product_status ON purchases_history (user_id, product_name, status, timestamp, purchase_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_last_activity ON users (last_activity)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pending_payments_status ON pending_payments (status, timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_wallet_ledger_user ON wallet_ledger (user_id, amount)")
+
+def _migration_daily_stats(cursor):
+    """Adds the per-day stats counters and backfills them from the existing rows."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            key TEXT NOT NULL DEFAULT '',
+            count INTEGER NOT NULL DEFAULT 0,
+            amount REAL NOT NULL DEFAULT 0.0,
+            PRIMARY KEY (day, metric, key)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS daily_active_users (
+            day TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id)
+        ) WITHOUT ROWID
+    """)
+
+    # الأيام تُؤخذ من أول عشرة أحرف، وهي نفسها في ISO وفي CURRENT_TIMESTAMP
+    cursor.execute("""
+        INSERT OR IGNORE INTO daily_active_users (day, user_id)
+        SELECT substr(last_activity, 1, 10), user_id FROM users WHERE substr(last_activity, 1, 10) >= ?
+    """, (_stats_day_start(STATS_ACTIVE_RETENTION_DAYS),))
+    cursor.execute("""
+        INSERT INTO daily_stats (day, metric, key, count, amount)
+        SELECT substr(created_at, 1, 10), 'new_users', '', COUNT(*), 0.0 FROM users WHERE created_at IS NOT NULL GROUP BY 1
+        UNION ALL
+        SELECT day, 'active_users', '', COUNT(*), 0.0 FROM daily_active_users GROUP BY day
+        UNION ALL
+        SELECT substr(created_at, 1, 10), 'deposits', '', COUNT(*), SUM(amount) FROM wallet_ledger
+        WHERE reason = 'deposit' AND amount > 0 GROUP BY 1
+        UNION ALL
+        SELECT substr(timestamp, 1, 10), 'purchases', product_name, COUNT(*), SUM(price) FROM purchases_history GROUP BY 1, 3
+    """)
+
+# الترتيب مهم: الترحيل رقم n يرفع user_version من n-1 إلى n، ولا يُحذف أو يُعدل بعد إصداره
+MIGRATIONS = [
+    _migration_base_schema,
+    _migration_wallet_ledger,
+    _migration_query_indexes,
+    _migration_daily_stats,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def migrate(conn: sqlite3.Connection, target: int = SCHEMA_VERSION) -> int:
+    """Applies the pending migrations up to ``target``, each in its own transaction.
+
+    Returns the resulting schema version.
+    """
     cursor = conn.cursor()
-    cursor.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"Database schema version {version} is newer than this code ({SCHEMA_VERSION})")
+    for number in range(version + 1, target + 1):
+        migration = MIGRATIONS[number - 1]
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {number}")
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        logger.info(f"Applied database migration {number}: {migration.__name__}")
+        version = number
+    return version
+
+def init_db():
+    """Initializes the database, bringing its schema up to SCHEMA_VERSION."""
+    conn = sqlite3.connect(DATABASE_NAME, isolation_level=None) # نتحكم بالمعاملات يدوياً في الترحيلات
+    try:
+        conn.execute("PRAGMA journal_mode=WAL") # يبقى مفعلاً في ملف قاعدة البيانات لكل الاتصالات
+        version = migrate(conn)
+    finally:
+        conn.close()
+    logger.info(f"Database initialized successfully (schema version {version}).")
+
+# --- الاستعلامات: كل دالة متزامنة تأخذ اتصالاً من المجموعة وتُنفذ على خيط منفصل ---
+def _get_user_wallet(conn, user_id):
+    result = conn.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,)).fetchone()
     if result:
         return result[0]
     return 0.0
 
-async def update_user_wallet_db(user_id: int, amount: float, username: str = None):
-    """Updates the user's wallet balance in the database.
-    Also updates last_activity and sets created_at for new users."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    
+# --- تعديل المحفظة: إضافة ذرية (balance = balance + ?) مع قيد في الدفتر داخل نفس المعاملة ---
+USER_INSERT = """
+    INSERT OR IGNORE INTO users (user_id, username, balance, created_at, last_activity) VALUES (?, ?, 0.0, ?, ?)
+"""
+WALLET_ADD = """
+    UPDATE users SET balance = balance + ?, last_activity = ? WHERE user_id = ? RETURNING balance
+"""
+LEDGER_INSERT = """
+    INSERT INTO wallet_ledger (user_id, amount, balance_after, reason, reference, created_at) VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+def _apply_wallet_change(conn, user_id, amount, username, reason, reference, current_time):
+    # rowcount يحدد بدقة إن كان المستخدم جديداً، حتى لو تكرر في نفس الدفعة
+    created = conn.execute(USER_INSERT, (user_id, username, current_time, current_time)).rowcount > 0
+    new_balance = conn.execute(WALLET_ADD, (amount, current_time, user_id)).fetchone()[0]
+    conn.execute(LEDGER_INSERT, (user_id, amount, new_balance, reason, reference, current_time))
+    day = current_time[:10]
+    if created:
+        _bump_stat(conn, day, "new_users")
+    _mark_active(conn, [(day, user_id)])
+    if reason == "deposit" and amount > 0:
+        _bump_stat(conn, day, "deposits", amount=amount)
+    return float(new_balance)
+
+def _update_user_wallet(conn, user_id, amount, username, reason, reference):
+    reason = reason or ("deposit" if amount > 0 else "purchase")
     current_time = datetime.now().isoformat()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        return _apply_wallet_change(conn, user_id, amount, username, reason, reference, current_time)
 
-    cursor.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
-    existing_user = cursor.fetchone()
+def _credit_wallets(conn, credits, reason):
+    current_time = datetime.now().isoformat()
+    balances = {}
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for user_id, amount, username, reference in credits:
+            balances[user_id] = _apply_wallet_change(conn, user_id, amount, username, reason, reference, current_time)
+    return balances
 
-    if existing_user:
-        new_balance = existing_user[0] + amount
-        cursor.execute("UPDATE users SET balance = ?, last_activity = ? WHERE user_id = ?", (new_balance, current_time, user_id))
-    else:
-        new_balance = amount
-        if username:
-             cursor.execute("INSERT INTO users (user_id, username, balance, created_at, last_activity) VALUES (?, ?, ?, ?, ?)", (user_id, username, new_balance, current_time, current_time))
-        else:
-             cursor.execute("INSERT INTO users (user_id, balance, created_at, last_activity) VALUES (?, ?, ?, ?)", (user_id, new_balance, current_time, current_time))
-    
-    conn.commit()
-    conn.close()
+def _verify_wallet_ledger(conn):
+    return conn.execute("""
+        SELECT u.user_id, u.balance, COALESCE(l.total, 0.0)
+        FROM users u
+        LEFT JOIN (SELECT user_id, SUM(amount) AS total FROM wallet_ledger GROUP BY user_id) l ON l.user_id = u.user_id
+        WHERE ABS(u.balance - COALESCE(l.total, 0.0)) > 1e-6
+    """).fetchall()
+
+def _write_activity(conn, rows):
+    with conn:
+        # MAX حتى لا تُرجع الدفعة وقتاً أحدث كتبته عملية أخرى (مثل تعديل المحفظة)
+        conn.executemany("UPDATE users SET last_activity = MAX(COALESCE(last_activity, ''), ?) WHERE user_id = ?", rows)
+        _mark_active(conn, [(timestamp[:10], user_id) for timestamp, user_id in rows])
+        conn.execute("DELETE FROM daily_active_users WHERE day < ?", (_stats_day_start(STATS_ACTIVE_RETENTION_DAYS),))
+
+
+class ActivityBuffer:
+    """Write-behind buffer for users' last_activity timestamps.
+
+    ``record`` only remembers the latest timestamp per user in memory; the
+    buffer is written with one ``executemany`` transaction every
+    ``flush_interval`` seconds, or as soon as ``max_pending`` users are
+    waiting, instead of one committed UPDATE per interaction.
+    """
+
+    def __init__(self, flush_interval: float = ACTIVITY_FLUSH_INTERVAL, max_pending: int = ACTIVITY_FLUSH_SIZE):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._writing = {}
+        self._task = None
+        self._flushing = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def record(self, user_id: int, timestamp: str = None):
+        self._pending[user_id] = timestamp or datetime.now().isoformat()
+        self.start()
+        if len(self._pending) >= self.max_pending and self._flushing is None:
+            self._flushing = asyncio.get_running_loop().create_task(self.flush())
+
+    def active_days(self) -> list[list]:
+        """``[user_id, day]`` for every buffered user (including a flush in progress)."""
+        latest = {**self._writing, **self._pending}
+        return [[user_id, timestamp[:10]] for user_id, timestamp in latest.items()]
+
+    def active_since(self, cutoff: str) -> list[int]:
+        """Buffered users (including a flush in progress) active at or after ``cutoff``."""
+        latest = {**self._writing, **self._pending}
+        return [user_id for user_id, timestamp in latest.items() if timestamp >= cutoff]
+
+    async def flush(self):
+        try:
+            async with self._lock: # دفعة واحدة في كل مرة حتى يبقى _writing صحيحاً
+                await self._flush()
+        finally:
+            if self._flushing is asyncio.current_task():
+                self._flushing = None
+
+    async def _flush(self):
+        if not self._pending:
+            return
+        self._writing, self._pending = self._pending, {}
+        started = time.perf_counter()
+        try:
+            await get_pool().run(_write_activity, [(timestamp, user_id) for user_id, timestamp in self._writing.items()])
+            histogram("db_activity_flush_seconds", "Duration of one last_activity flush.").observe(time.perf_counter() - started)
+            counter("db_activity_flush_rows_total", "last_activity rows written by the activity buffer.").inc(len(self._writing))
+        except Exception as e:
+            logger.error(f"Activity flush failed for {len(self._writing)} users, will retry: {e}")
+            for user_id, timestamp in self._writing.items():
+                if timestamp > self._pending.get(user_id, ""):
+                    self._pending[user_id] = timestamp
+        finally:
+            self._writing = {}
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if self._pending:
+                await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Stops the periodic flush and writes whatever is still buffered."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._flushing is not None:
+            await self._flushing
+        await self.flush()
+        logger.info("User activity flushed on shutdown.")
+
+
+activity_buffer = ActivityBuffer()
+
+# --- عدادات الإحصائيات اليومية: تُحدث داخل معاملة الكتابة نفسها ---
+def _stats_day_start(days_back: int = 0) -> str:
+    return (datetime.now() - timedelta(days=days_back)).date().isoformat()
+
+def _bump_stat(conn, day, metric, key="", count=1, amount=0.0):
+    conn.execute("""
+        INSERT INTO daily_stats (day, metric, key, count, amount) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(day, metric, key) DO UPDATE SET count = count + excluded.count, amount = amount + excluded.amount
+    """, (day, metric, key, count, amount))
+
+def _mark_active(conn, rows):
+    """Adds (day, user_id) pairs to the daily active sets, counting each user once per day."""
+    new_per_day = {}
+    for day, user_id in rows:
+        # المستخدمون غير المسجلين لا يُحتسبون، كما في جدول users
+        inserted = conn.execute("""
+            INSERT OR IGNORE INTO daily_active_users (day, user_id) SELECT ?, user_id FROM users WHERE user_id = ?
+        """, (day, user_id)).rowcount
+        if inserted > 0:
+            new_per_day[day] = new_per_day.get(day, 0) + inserted
+    for day, count in new_per_day.items():
+        _bump_stat(conn, day, "active_users", count=count)
+
+def _add_purchase(conn, purchase_id, user_id, username, product_name, game_id, price, timestamp):
+    with conn:
+        conn.execute("""
+            INSERT INTO purchases_history (purchase_id, user_id, username, product_name, game_id, price, status, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (purchase_id, user_id, username, product_name, game_id, price, "pending_shipment", timestamp))
+        _bump_stat(conn, timestamp[:10], "purchases", key=product_name, amount=price)
+
+def _add_pending_payment(conn, payment_id, user_id, username, amount, transaction_id, payment_method, timestamp):
+    with conn:
+        conn.execute("""
+            INSERT INTO pending_payments (payment_id, user_id, username, amount, transaction_id, payment_method, status, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (payment_id, user_id, username, amount, transaction_id, payment_method, "pending", timestamp))
+
+def _fetch_one(conn, query, params):
+    return conn.execute(query, params).fetchone()
+
+def _fetch_all(conn, query, params):
+    return conn.execute(query, params).fetchall()
+
+def _execute(conn, query, params):
+    with conn:
+        conn.execute(query, params)
+
+@timed_query
+async def get_user_wallet_db(user_id: int) -> float:
+    """Fetches the user's wallet balance from the database."""
+    return await get_pool().run(_get_user_wallet, user_id)
+
+@timed_query
+async def update_user_wallet_db(user_id: int, amount: float, username: str = None,
+                                reason: str = None, reference: str = None):
+    """Atomically adds ``amount`` to the user's wallet and records it in wallet_ledger.
+    Also updates last_activity and sets created_at for new users.
+
+    Without a ``reason``, credits are recorded as ``deposit`` and debits as
+    ``purchase``, the two ways the shop changes a balance."""
+    new_balance = await get_pool().run(_update_user_wallet, user_id, amount, username, reason, reference)
     logger.info(f"User {user_id} wallet updated. New balance: {new_balance} (Database)")
     return new_balance
 
+@timed_query
+async def credit_wallets_db(credits: list[tuple], reason: str = "deposit") -> dict[int, float]:
+    """Credits many wallets in a single transaction, e.g. a batch of approved deposits.
+
+    ``credits`` holds ``(user_id, amount, username, reference)`` tuples; returns
+    the new balance of every credited user.
+    """
+    balances = await get_pool().run(_credit_wallets, credits, reason)
+    logger.info(f"Credited {len(credits)} wallet changes for {len(balances)} users ({reason}).")
+    return balances
+
+@timed_query
+async def verify_wallet_ledger_db() -> list[dict]:
+    """Returns the users whose balance does not match the sum of their ledger entries."""
+    rows = await get_pool().run(_verify_wallet_ledger)
+    return [{"user_id": user_id, "balance": balance, "ledger_balance": ledger_balance}
+            for user_id, balance, ledger_balance in rows]
+
+@timed_query
 async def update_user_activity_db(user_id: int):
-    """Updates the last_activity timestamp for a user."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    current_time = datetime.now().isoformat()
-    cursor.execute("UPDATE users SET last_activity = ? WHERE user_id = ?", (current_time, user_id))
-    conn.commit()
-    conn.close()
+    """Records the last_activity timestamp for a user (written in batches by activity_buffer)."""
+    activity_buffer.record(user_id)
     logger.debug(f"User {user_id} last activity updated.")
 
 
+@timed_query
 async def add_pending_payment_db(user_id: int, username: str, amount: float, transaction_id: str, payment_method: str = "Unknown"):
     """Adds a pending payment to the database."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
     payment_id = str(uuid.uuid4())
     timestamp = datetime.now().isoformat() # Use isoformat for consistency
-    
-    cursor.execute("""
-        INSERT INTO pending_payments (payment_id, user_id, username, amount, transaction_id, payment_method, status, timestamp)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    """, (payment_id, user_id, username, amount, transaction_id, payment_method, "pending", timestamp))
-    
-    conn.commit()
-    conn.close()
+    await get_pool().run(_add_pending_payment, payment_id, user_id, username, amount, transaction_id, payment_method, timestamp)
     logger.info(f"Pending payment added to DB for user {user_id}: {payment_id} via {payment_method}")
     return payment_id
 
+@timed_query
 async def get_pending_payment_db(payment_id: str):
     """Fetches a pending payment by its ID."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM pending_payments WHERE payment_id = ?", (payment_id,))
-    result = cursor.fetchone()
-    conn.close()
+    result = await get_pool().run(_fetch_one, "SELECT * FROM pending_payments WHERE payment_id = ?", (payment_id,))
     if result:
         keys = ["payment_id", "user_id", "username", "amount", "transaction_id", "payment_method", "status", "timestamp"]
         return dict(zip(keys, result))
     return None
 
+@timed_query
+async def get_pending_payments_by_status_db(status: str = "pending", limit: int = 50):
+    """Fetches the oldest payments with the given status, e.g. for the admin review queue."""
+    results = await get_pool().run(_fetch_all, "SELECT * FROM pending_payments WHERE status = ? ORDER BY timestamp LIMIT ?", (status, limit))
+    keys = ["payment_id", "user_id", "username", "amount", "transaction_id", "payment_method", "status", "timestamp"]
+    return [dict(zip(keys, row)) for row in results]
+
+@timed_query
 async def update_pending_payment_status_db(payment_id: str, status: str):
     """Updates the status of a pending payment."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE pending_payments SET status = ? WHERE payment_id = ?", (status, payment_id))
-    conn.commit()
-    conn.close()
+    await get_pool().run(_execute, "UPDATE pending_payments SET status = ? WHERE payment_id = ?", (status, payment_id))
     logger.info(f"Pending payment {payment_id} status updated to {status}.")
 
+@timed_query
 async def add_purchase_history_db(user_id: int, username: str, product_name: str, game_id: str, price: float):
     """Adds a completed purchase to the history."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
     purchase_id = str(uuid.uuid4())
     timestamp = datetime.now().isoformat()
-
-    cursor.execute("""
-        INSERT INTO purchases_history (purchase_id, user_id, username, product_name, game_id, price, status, timestamp)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    """, (purchase_id, user_id, username, product_name, game_id, price, "pending_shipment", timestamp))
-
-    conn.commit()
-    conn.close()
+    await get_pool().run(_add_purchase, purchase_id, user_id, username, product_name, game_id, price, timestamp)
     logger.info(f"Purchase added to DB for user {user_id}: {purchase_id}")
     return purchase_id
 
+@timed_query
 async def get_user_purchases_history_db(user_id: int):
     """Fetches all purchase history for a given user."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM purchases_history WHERE user_id = ? ORDER BY timestamp DESC", (user_id,))
-    results = cursor.fetchall()
-    conn.close()
-    
+    results = await get_pool().run(_fetch_all, "SELECT * FROM purchases_history WHERE user_id = ? ORDER BY timestamp DESC", (user_id,))
+
     history = []
     keys = ["purchase_id", "user_id", "username", "product_name", "game_id", "price", "status", "timestamp", "shipped_at"]
     for row in results:
         history.append(dict(zip(keys, row)))
     return history
 
+@timed_query
 async def get_purchase_by_details_db(user_id: int, product_name: str, status: str = 'pending_shipment'):
     """Fetches a specific purchase by user_id, product_name and status."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    cursor.execute("""
+    result = await get_pool().run(_fetch_one, """
         SELECT purchase_id FROM purchases_history
         WHERE user_id = ? AND product_name = ? AND status = ?
         ORDER BY timestamp DESC LIMIT 1
     """, (user_id, product_name, status))
-    result = cursor.fetchone()
-    conn.close()
     return result[0] if result else None
 
+@timed_query
 async def update_purchase_status_db(purchase_id: str, status: str, shipped_at: str = None):
     """Updates the status of a purchase in the history."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
     if shipped_at:
-        cursor.execute("UPDATE purchases_history SET status = ?, shipped_at = ? WHERE purchase_id = ?", (status, shipped_at, purchase_id))
+        await get_pool().run(_execute, "UPDATE purchases_history SET status = ?, shipped_at = ? WHERE purchase_id = ?", (status, shipped_at, purchase_id))
     else:
-        cursor.execute("UPDATE purchases_history SET status = ? WHERE purchase_id = ?", (status, purchase_id))
-    conn.commit()
-    conn.close()
+        await get_pool().run(_execute, "UPDATE purchases_history SET status = ? WHERE purchase_id = ?", (status, purchase_id))
     logger.info(f"Purchase {purchase_id} status updated to {status}.")
 
 
 # --- دوال الإحصائيات الجديدة ---
+@timed_query
 async def get_total_users_db() -> int:
     """Returns the total number of unique users."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(user_id) FROM users")
-    total_users = cursor.fetchone()[0]
-    conn.close()
-    return total_users
+    return (await get_pool().run(_fetch_one, "SELECT COALESCE(SUM(count), 0) FROM daily_stats WHERE metric = 'new_users'", ()))[0]
 
+@timed_query
 async def get_new_users_today_db() -> int:
     """Returns the number of new users registered today."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    today_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
-    cursor.execute("SELECT COUNT(user_id) FROM users WHERE created_at >= ?", (today_start,))
-    new_users = cursor.fetchone()[0]
-    conn.close()
-    return new_users
+    return (await get_pool().run(_fetch_one, "SELECT COALESCE(SUM(count), 0) FROM daily_stats WHERE day = ? AND metric = 'new_users'", (_stats_day_start(),)))[0]
 
+@timed_query
 async def get_active_users_last_24_hours_db() -> int:
     """Returns the number of users active in the last 24 hours."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
     time_24_hours_ago = (datetime.now() - timedelta(hours=24)).isoformat()
-    cursor.execute("SELECT COUNT(user_id) FROM users WHERE last_activity >= ?", (time_24_hours_ago,))
-    active_users = cursor.fetchone()[0]
-    conn.close()
-    return active_users
+    # النشاط الذي لم يُكتب بعد يُحتسب أيضاً، مرة واحدة لكل مستخدم
+    buffered = json.dumps(activity_buffer.active_since(time_24_hours_ago))
+    return (await get_pool().run(_fetch_one, """
+        SELECT COUNT(user_id) FROM users
+        WHERE last_activity >= ? OR user_id IN (SELECT value FROM json_each(?))
+    """, (time_24_hours_ago, buffered)))[0]
+
+STATS_WINDOWS = {"today": 0, "7d": 6, "30d": 29} # عدد الأيام السابقة لليوم الحالي في كل نافذة
+
+DASHBOARD_QUERY = """
+    WITH windows(name, start) AS (SELECT key, value FROM json_each(?)),
+    buffered(user_id, day) AS (
+        SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]') FROM json_each(?)
+        WHERE json_extract(value, '$[0]') IN (SELECT user_id FROM users)
+    )
+    SELECT
+        (SELECT COALESCE(SUM(count), 0) FROM daily_stats WHERE metric = 'new_users'),
+        json_group_object(w.name, json_object(
+            'new_users', (SELECT COALESCE(SUM(count), 0) FROM daily_stats WHERE metric = 'new_users' AND day >= w.start),
+            'active_users', (SELECT COUNT(*) FROM (
+                SELECT user_id FROM daily_active_users WHERE day >= w.start
+                UNION SELECT user_id FROM buffered WHERE day >= w.start
+            )),
+            'deposits', (SELECT COALESCE(SUM(count), 0) FROM daily_stats WHERE metric = 'deposits' AND day >= w.start),
+            'deposit_amount', (SELECT COALESCE(SUM(amount), 0.0) FROM daily_stats WHERE metric = 'deposits' AND day >= w.start),
+            'purchases', (SELECT COALESCE(SUM(count), 0) FROM daily_stats WHERE metric = 'purchases' AND day >= w.start),
+            'revenue', (SELECT COALESCE(SUM(amount), 0.0) FROM daily_stats WHERE metric = 'purchases' AND day >= w.start),
+            'products', json(COALESCE((SELECT json_group_object(key, json_object('count', count, 'revenue', revenue)) FROM (
+                SELECT key, SUM(count) AS count, SUM(amount) AS revenue FROM daily_stats
+                WHERE metric = 'purchases' AND day >= w.start GROUP BY key ORDER BY revenue DESC
+            )), '{}'))
+        ))
+    FROM windows w
+"""
+
+@timed_query
+async def get_dashboard_stats_db() -> dict:
+    """Returns the admin dashboard in one query over the daily counters.
+
+    ``total_users`` plus, for each window in STATS_WINDOWS, the new users,
+    distinct active users (buffered activity included), deposits, purchases
+    and revenue per product.
+    """
+    windows = json.dumps({name: _stats_day_start(days_back) for name, days_back in STATS_WINDOWS.items()})
+    buffered = json.dumps(activity_buffer.active_days())
+    total_users, by_window = await get_pool().run(_fetch_one, DASHBOARD_QUERY, (windows, buffered))
+    return {"total_users": total_users, **json.loads(by_window)}
 
 # --- دالة جديدة لجلب جميع معرفات المستخدمين (للبث) ---
+@timed_query
 async def get_all_user_ids_db() -> list[int]:
     """Returns a list of all user IDs in the database."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id FROM users")
-    user_ids = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return user_ids
\ No newline at end of file
+    rows = await get_pool().run(_fetch_all, "SELECT user_id FROM users", ())
+    return [row[0] for row in rows]
@@ -0,0 +1,139 @@
+# db_benchmark.py
+"""Query timings for database.py before and after the index migration.
+
+Builds a throwaway database at the schema version just before the index
+migration, fills ``users``, ``purchases_history`` and ``pending_payments``
+with synthetic rows, times the real ``*_db`` query functions, then applies
+the index migration and times them again.
+
+    python db_benchmark.py --rows 1000000 --repeat 20
+
+Everything lives in a temporary directory that is removed afterwards.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import database
+
+INDEX_MIGRATION = database.MIGRATIONS.index(database._migration_query_indexes) + 1
+
+PRODUCTS = ["شدات ببجي 60", "شدات ببجي 325", "جواهر فري فاير 100", "جواهر فري فاير 520", "بطاقة جوجل بلاي 10$"]
+STATUSES = ["pending_shipment", "shipped", "cancelled"]
+PAYMENT_STATUSES = ["pending", "approved", "rejected"]
+
+
+def timestamps(rng, count, days=365):
+    now = datetime.now()
+    for _ in range(count):
+        yield (now - timedelta(seconds=rng.uniform(0, days * 86400))).isoformat()
+
+
+def fill(path, rows, users, seed):
+    """Inserts ``rows`` users, purchases and payments (with ``users`` distinct buyers)."""
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany(
+            "INSERT INTO users (user_id, username, balance, created_at, last_activity) VALUES (?, ?, ?, ?, ?)",
+            ((user_id, f"user{user_id}", 0.0, created, active)
+             for user_id, created, active in zip(range(1, rows + 1), timestamps(rng, rows), timestamps(rng, rows, days=30)))
+        )
+        conn.executemany(
+            "INSERT INTO purchases_history (purchase_id, user_id, username, product_name, game_id, price, status, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            ((str(uuid.UUID(int=rng.getrandbits(128))), user_id, f"user{user_id}", rng.choice(PRODUCTS), str(rng.randrange(10**9)),
+              rng.choice((1.0, 5.0, 10.0)), rng.choice(STATUSES), stamp)
+             for user_id, stamp in ((rng.randint(1, users), stamp) for stamp in timestamps(rng, rows)))
+        )
+        conn.executemany(
+            "INSERT INTO pending_payments (payment_id, user_id, username, amount, transaction_id, payment_method, status, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            ((str(uuid.UUID(int=rng.getrandbits(128))), user_id, f"user{user_id}", 10.0, str(rng.randrange(10**9)), "Syriatel Cash",
+              "pending" if rng.random() < 0.01 else rng.choice(PAYMENT_STATUSES[1:]), stamp)
+             for user_id, stamp in ((rng.randint(1, users), stamp) for stamp in timestamps(rng, rows)))
+        )
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+def queries(rng, users):
+    user_id = rng.randint(1, users)
+    return {
+        "get_user_purchases_history_db": database.get_user_purchases_history_db(user_id),
+        "get_purchase_by_details_db": database.get_purchase_by_details_db(user_id, rng.choice(PRODUCTS)),
+        "get_pending_payments_by_status_db": database.get_pending_payments_by_status_db("pending"),
+        "get_active_users_last_24_hours_db": database.get_active_users_last_24_hours_db(),
+    }
+
+
+async def time_queries(repeat, users, seed) -> dict:
+    rng = random.Random(seed)
+    timings = {}
+    for _ in range(repeat):
+        for name, query in queries(rng, users).items():
+            started = time.perf_counter()
+            await query
+            timings.setdefault(name, []).append((time.perf_counter() - started) * 1000)
+    return {name: statistics.median(samples) for name, samples in timings.items()}
+
+
+def run(rows, users, repeat, seed) -> dict:
+    workdir = tempfile.mkdtemp(prefix="db-benchmark-")
+    try:
+        database.DATABASE_NAME = os.path.join(workdir, "bot_data.db")
+        conn = sqlite3.connect(database.DATABASE_NAME, isolation_level=None)
+        database.migrate(conn, target=INDEX_MIGRATION - 1)
+        conn.close()
+
+        started = time.perf_counter()
+        fill(database.DATABASE_NAME, rows, users, seed)
+        fill_seconds = time.perf_counter() - started
+
+        before = asyncio.run(time_queries(repeat, users, seed))
+        database.close_db()
+
+        conn = sqlite3.connect(database.DATABASE_NAME, isolation_level=None)
+        started = time.perf_counter()
+        database.migrate(conn, target=INDEX_MIGRATION)
+        migrate_seconds = time.perf_counter() - started
+        conn.execute("ANALYZE")
+        conn.close()
+
+        after = asyncio.run(time_queries(repeat, users, seed))
+        database.close_db()
+        return {"rows": rows, "fill_seconds": fill_seconds, "migrate_seconds": migrate_seconds,
+                "before_ms": before, "after_ms": after}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time database.py queries before and after the index migration.")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="rows per table")
+    parser.add_argument("--users", type=int, default=100_000, help="distinct users owning purchases and payments")
+    parser.add_argument("--repeat", type=int, default=20, help="runs per query (the median is reported)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    args = parser.parse_args()
+
+    result = run(args.rows, min(args.users, args.rows), args.repeat, args.seed)
+    if args.json:
+        print(json.dumps(result))
+        return
+    print(f"{args.rows} rows per table, filled in {result['fill_seconds']:.1f}s, index migration took {result['migrate_seconds']:.1f}s")
+    print(f"{'query':<36} {'before ms':>11} {'after ms':>11} {'speedup':>9}")
+    for name, before in result["before_ms"].items():
+        after = result["after_ms"][name]
+        print(f"{name:<36} {before:>11.2f} {after:>11.2f} {before / after if after else float('inf'):>8.0f}x")
+
+
+if __name__ == '__main__':
+    main()
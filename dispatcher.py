@@ -0,0 +1,59 @@
+# dispatcher.py
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class UserDispatcher:
+    """Runs at most one turn per user at a time and merges message bursts.
+
+    ``submit`` is awaited from the update handler. If the user has no turn in
+    flight, the caller becomes that user's worker and processes the message;
+    messages that arrive meanwhile are queued and, once the running turn
+    finishes, handed to ``process_batch`` together as a single merged turn.
+    Different users never wait for each other. A failed turn is passed to
+    ``on_error(batch, error)`` so the user still gets an answer, and the
+    queued messages are processed as usual.
+    """
+
+    def __init__(self, process_batch, on_error=None):
+        self.process_batch = process_batch
+        self.on_error = on_error
+        self._pending = {}
+        self._active = set()
+
+    @property
+    def depth(self) -> int:
+        """Number of queued messages waiting behind an in-flight turn."""
+        return sum(len(items) for items in self._pending.values())
+
+    @property
+    def active_users(self) -> int:
+        return len(self._active)
+
+    def is_active(self, user_id) -> bool:
+        """True while a turn for the user is running or queued."""
+        user_id = str(user_id)
+        return user_id in self._active or bool(self._pending.get(user_id))
+
+    async def submit(self, user_id, *item):
+        user_id = str(user_id)
+        self._pending.setdefault(user_id, []).append(item)
+        if user_id in self._active:
+            return
+        self._active.add(user_id)
+        try:
+            while self._pending.get(user_id):
+                batch = self._pending.pop(user_id)
+                try:
+                    await self.process_batch(batch)
+                except Exception as e:
+                    if self.on_error is None:
+                        logger.exception(f"Turn for user {user_id} failed")
+                        continue
+                    try:
+                        await self.on_error(batch, e)
+                    except Exception:
+                        logger.exception(f"Error handler for user {user_id} failed")
+        finally:
+            self._active.discard(user_id)
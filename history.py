@@ -0,0 +1,108 @@
+# history.py
+"""Compact per-user conversation history.
+
+A ``ConversationHistory`` keeps the recent turns as ``(role, text)`` tuples in
+a ring buffer bounded both by turn count and by total text size, instead of
+one ``{'role': ..., 'parts': [...]}`` dict per turn. On disk it is stored as
+``[["u", text], ["m", text], ...]``; the API-shaped payload is only built by
+``to_api`` when a request is actually sent.
+"""
+import os
+from collections import deque
+
+MAX_TURNS = int(os.getenv('HISTORY_MAX_TURNS', "40"))
+MAX_BYTES = int(os.getenv('HISTORY_MAX_BYTES', "65536")) # حجم النصوص المحفوظة لكل مستخدم
+
+USER = "user"
+MODEL = "model"
+_ROLE_CODES = {USER: "u", MODEL: "m"}
+_CODE_ROLES = {code: role for role, code in _ROLE_CODES.items()}
+
+
+def _size(text: str) -> int:
+    return len(text.encode('utf-8'))
+
+
+class ConversationHistory:
+    __slots__ = ("_turns", "_bytes")
+
+    def __init__(self, turns=()):
+        self._turns = deque()
+        self._bytes = 0
+        for role, text in turns:
+            self.append(role, text)
+
+    def __len__(self):
+        return len(self._turns)
+
+    def __iter__(self):
+        return iter(self._turns)
+
+    def __eq__(self, other):
+        return isinstance(other, ConversationHistory) and self._turns == other._turns
+
+    def __repr__(self):
+        return f"ConversationHistory({len(self._turns)} turns, {self._bytes} bytes)"
+
+    @property
+    def nbytes(self) -> int:
+        """Total UTF-8 size of the stored texts."""
+        return self._bytes
+
+    def append(self, role: str, text: str) -> list[tuple]:
+        """Adds a turn and returns the oldest turns it pushed out of the buffer."""
+        # الأدوار ثابتة مشتركة حتى لا تُخزن نسخة لكل رسالة
+        role = USER if role == USER else MODEL
+        self._turns.append((role, text))
+        self._bytes += _size(text)
+        dropped = []
+        while len(self._turns) > MAX_TURNS or (self._bytes > MAX_BYTES and len(self._turns) > 1):
+            dropped.append(self._turns.popleft())
+            # نسقط الرد مع رسالته حتى يبدأ السجل دائماً برسالة من المستخدم
+            while len(self._turns) > 1 and self._turns[0][0] == MODEL:
+                dropped.append(self._turns.popleft())
+        self._bytes -= sum(_size(text) for _, text in dropped)
+        return dropped
+
+    def oldest(self, count: int) -> list[tuple]:
+        """Returns the ``count`` oldest (role, text) turns."""
+        return [self._turns[i] for i in range(min(count, len(self._turns)))]
+
+    def drop_oldest(self, count: int):
+        for _ in range(min(count, len(self._turns))):
+            self._bytes -= _size(self._turns.popleft()[1])
+
+    def to_api(self) -> list[dict]:
+        """Builds the Gemini ``contents`` turns for this history."""
+        return [{'role': role, 'parts': [text]} for role, text in self._turns]
+
+    def to_json(self) -> list:
+        return [[_ROLE_CODES[role], text] for role, text in self._turns]
+
+    @classmethod
+    def from_json(cls, data) -> "ConversationHistory":
+        """Reads the compact format as well as the legacy list of API-shaped dicts."""
+        history = cls()
+        for turn in data or []:
+            if isinstance(turn, dict):
+                text = " ".join(part for part in turn.get('parts', []) if isinstance(part, str))
+                history.append(turn.get('role'), text)
+            else:
+                code, text = turn
+                history.append(_CODE_ROLES.get(code, code), text)
+        return history
+
+
+def history_of(record: dict) -> ConversationHistory:
+    """Returns the record's history, converting a plain list on first access."""
+    history = record.get('conversation_history')
+    if not isinstance(history, ConversationHistory):
+        history = record['conversation_history'] = ConversationHistory.from_json(history)
+    return history
+
+
+def encode_json(value):
+    """``default`` hook for ``json.dumps`` so records holding a history serialize compactly."""
+    if isinstance(value, ConversationHistory):
+        return value.to_json()
+    raise TypeError(f"Object of type {value.__class__.__name__} is not JSON serializable")
@@ -0,0 +1,192 @@
+# intent_classifier.py
+import json
+import logging
+import math
+import re
+from collections import Counter
+from typing import NamedTuple
+
+import pytz
+
+from time_parser import parse_reminder
+
+logger = logging.getLogger(__name__)
+
+INTENTS = ("conversation", "search", "reminder", "remember_fact")
+
+# التشكيل والتطويل لا يغيران المعنى، لذا نحذفهما قبل المطابقة
+_DIACRITICS_RE = re.compile(r"[\u064B-\u065F\u0670\u0640]")
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+class IntentResult(NamedTuple):
+    intent: str
+    data: str
+    confidence: float
+    source: str  # "rules" | "model" | "default"
+
+
+# --- القواعد: (القصد، النمط، الثقة) ---
+# كل نمط يلتقط البيانات المستخرجة في المجموعة "data" بنفس الشكل الذي يرجعه الموجه الذكي
+_RULES = [
+    ("reminder", re.compile(
+        r"^\s*(?:(?:من فضلك|لو سمحت|رجاء)[،,]?\s+)?"
+        r"(?:ذكر|ذكري|ذكرني|ذكريني|نبهني|نبهيني|فكرني|فكريني)"
+        r"\s+(?:(?:ب[اأ]ن|[اأ]ن)\s+|ب(?=\S\S))?(?P<data>.+)", re.S), 0.95),
+    ("reminder", re.compile(
+        r"\b(?:remind me|set (?:a|an) reminder|set reminder)\b(?:\s+(?:to|about|that))?\s+(?P<data>.+)",
+        re.I | re.S), 0.95),
+    ("search", re.compile(
+        r"^\s*(?:(?:ابحث|ابحثي)(?:\s+لي)?(?:\s+(?:عن|على))?|(?:دور|دوري|فتش|فتشي)(?:\s+لي)?\s+(?:عن|على))\s+(?P<data>.+)", re.S), 0.9),
+    # "دور" وحدها قد تكون الاسم (دور الشمس في الحياة)، فيقرر النموذج
+    ("search", re.compile(r"^\s*(?:دور|دوري|فتش|فتشي)(?:\s+لي)?\s+(?P<data>.+)", re.S), 0.5),
+    ("search", re.compile(
+        r"^\s*(?:please\s+)?(?:(?:can|could) you\s+)?"
+        r"(?:search(?:\s+(?:the web|the internet|online|google))?\s+(?:for|about)"
+        # "look up at the sky" و"google is great" ليست طلبات بحث
+        r"|look up(?!\s+(?:at|to|into|from|in|on|and)\b)"
+        r"|google(?!\s+(?:is|was|are|were|has|had|does|did|will|can|and|it|its)\b))"
+        r"\s+(?P<data>.+)", re.I | re.S), 0.9),
+    # فعل البحث وحده قد يكون جزءاً من دردشة، فثقته أقل من حد التوجيه ويقرر النموذج
+    ("search", re.compile(r"^\s*search\s+(?P<data>.+)", re.I | re.S), 0.5),
+    ("remember_fact", re.compile(
+        r"^\s*(?:تذكر|تذكري|احفظ|احفظي)\s+(?:(?:[اأإ]ن|ب[اأ]ن)\s+)?(?P<data>.+)", re.S), 0.85),
+    ("remember_fact", re.compile(
+        r"^\s*(?:please\s+)?remember(?:\s+that)?\s+(?P<data>.+)", re.I | re.S), 0.85),
+]
+
+# "remember when..." و"تذكر لما..." استرجاع لذكرى وليست طلب حفظ
+_RECALL_RE = re.compile(r"^(?:when|how|what|the time|لما|لمّا|عندما|حين|ايام|أيام|كيف|شو|متى)\b", re.I)
+_LOW_CONFIDENCE = 0.5
+
+
+def _has_request_shape(intent: str, data: str, clean: str) -> bool:
+    """Whether a rule match really looks like the request, not chat that shares its verb."""
+    if clean.rstrip().endswith(("?", "؟")):
+        return False
+    if intent == "reminder":
+        # بدون وقت يفهمه المحلل ("ذكرني كيف كان يومك") لا نعرف أنه تذكير فعلاً
+        return parse_reminder(data, pytz.utc) is not None
+    if intent == "remember_fact":
+        return not _RECALL_RE.match(data)
+    return True
+
+
+# كلمات تدل على أن الرسالة قد تحمل طلباً وليست مجرد دردشة، فلا نحكم عليها محلياً
+_AMBIGUOUS_HINTS = re.compile(
+    r"ذكر|نبه|منبه|تذكير|ابحث|بحث|دور|فتش|احفظ|تذكر|remind|search|look up|google|remember|alarm",
+    re.I
+)
+
+
+def normalize(text: str) -> str:
+    return _DIACRITICS_RE.sub("", text or "").strip()
+
+
+def tokenize(text: str) -> list[str]:
+    return _TOKEN_RE.findall(normalize(text).lower())
+
+
+class NaiveBayesIntentModel:
+    """Tiny multinomial naive Bayes model stored as a JSON file.
+
+    The file holds log priors and per-token log likelihoods for each intent;
+    ``train`` and ``save`` produce it from labelled (text, intent) samples.
+    """
+
+    def __init__(self, priors: dict, likelihoods: dict, unknown: dict):
+        self.priors = priors
+        self.likelihoods = likelihoods
+        self.unknown = unknown
+
+    @classmethod
+    def train(cls, samples, alpha: float = 1.0):
+        token_counts = {intent: Counter() for intent in INTENTS}
+        doc_counts = Counter()
+        for text, intent in samples:
+            token_counts[intent].update(tokenize(text))
+            doc_counts[intent] += 1
+        vocabulary = set().union(*token_counts.values())
+        total_docs = sum(doc_counts.values())
+        priors, likelihoods, unknown = {}, {}, {}
+        for intent in INTENTS:
+            priors[intent] = math.log((doc_counts[intent] + alpha) / (total_docs + alpha * len(INTENTS)))
+            denominator = sum(token_counts[intent].values()) + alpha * (len(vocabulary) + 1)
+            likelihoods[intent] = {token: math.log((count + alpha) / denominator) for token, count in token_counts[intent].items()}
+            unknown[intent] = math.log(alpha / denominator)
+        return cls(priors, likelihoods, unknown)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, 'r', encoding='utf-8') as f:
+            raw = json.load(f)
+        return cls(raw["priors"], raw["likelihoods"], raw["unknown"])
+
+    def save(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({"priors": self.priors, "likelihoods": self.likelihoods, "unknown": self.unknown}, f, ensure_ascii=False)
+
+    def predict(self, text: str) -> tuple[str, float]:
+        """Returns the most likely intent and its posterior probability."""
+        tokens = tokenize(text)
+        scores = {}
+        for intent, prior in self.priors.items():
+            table = self.likelihoods.get(intent, {})
+            scores[intent] = prior + sum(table.get(token, self.unknown[intent]) for token in tokens)
+        best = max(scores, key=scores.get)
+        total = sum(math.exp(score - scores[best]) for score in scores.values())
+        return best, 1.0 / total
+
+
+class IntentClassifier:
+    """Deterministic local intent classifier that runs before the LLM router.
+
+    Keyword rules handle the obvious Arabic/English requests; an optional
+    naive Bayes model covers the rest. Results below ``threshold`` should be
+    sent to the LLM router, and the counters in ``stats`` show how many LLM
+    calls the local path saved.
+    """
+
+    def __init__(self, threshold: float = 0.7, model_path: str = None):
+        self.threshold = threshold
+        self.model = None
+        if model_path:
+            try:
+                self.model = NaiveBayesIntentModel.load(model_path)
+                logger.info(f"Loaded local intent model from {model_path}")
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Could not load local intent model {model_path}: {e}")
+        self.stats = Counter()
+
+    def _classify(self, text: str) -> IntentResult:
+        clean = normalize(text)
+        for intent, pattern, confidence in _RULES:
+            match = pattern.search(clean)
+            if match:
+                data = match.group("data").strip()
+                if not _has_request_shape(intent, data, clean):
+                    confidence = min(confidence, _LOW_CONFIDENCE)
+                return IntentResult(intent, data, confidence, "rules")
+
+        if self.model:
+            intent, probability = self.model.predict(clean)
+            return IntentResult(intent, clean, probability, "model")
+
+        # لا توجد أي كلمة تدل على طلب: على الأغلب محادثة عادية
+        if clean and not _AMBIGUOUS_HINTS.search(clean):
+            return IntentResult("conversation", text, 0.75, "default")
+        return IntentResult("conversation", text, 0.3, "default")
+
+    def classify(self, text: str) -> IntentResult:
+        result = self._classify(text)
+        self.stats["total"] += 1
+        if result.confidence >= self.threshold:
+            self.stats["local_hits"] += 1
+            self.stats[f"local_{result.intent}"] += 1
+        else:
+            self.stats["llm_fallbacks"] += 1
+        return result
+
+    def hit_rate(self) -> float:
+        total = self.stats["total"]
+        return self.stats["local_hits"] / total if total else 0.0
@@ -0,0 +1,286 @@
+# llm_gateway.py
+"""Central gateway for every Gemini call made by the bot.
+
+All call sites go through ``LLMGateway`` so the process never has more than
+``max_concurrency`` requests in flight and stays inside the provider's
+requests-per-minute and tokens-per-minute limits. Waiting requests are served
+by priority class (interactive replies first, background work last); when the
+queue is full or a request waits too long, ``LLMOverloaded`` is raised so the
+caller can answer politely instead of failing at random.
+
+Each call site also has a latency deadline: when the primary model misses
+it, a hedged request goes to a faster model and whichever answers first
+wins, while the other request is cancelled.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- فئات الأولوية (الأصغر يُخدم أولاً) ---
+INTERACTIVE = 0
+REMINDER = 1
+BACKGROUND = 2
+
+PRIORITY_NAMES = {INTERACTIVE: "interactive", REMINDER: "reminder", BACKGROUND: "background"}
+
+DEFAULT_MAX_WAIT = {INTERACTIVE: 20.0, REMINDER: 60.0, BACKGROUND: 300.0}
+
+# مقدار تقريبي للرد نضيفه إلى تقدير توكنات الطلب
+EXPECTED_OUTPUT_TOKENS = 400
+
+
+PRIMARY_MODEL = os.getenv('LLM_PRIMARY_MODEL', "gemini-2.5-pro")
+FAST_MODEL = os.getenv('LLM_FAST_MODEL', "gemini-2.5-flash")
+
+# --- المهلة الافتراضية لكل موقع استدعاء قبل إرسال طلب احتياطي للنموذج الأسرع ---
+DEFAULT_DEADLINES = {
+    "intent": 4.0,
+    "reminder_parsing": 6.0,
+    "conversation": 15.0,
+    "route_and_reply": 15.0,
+    "search": 15.0,
+    "summarization": 30.0,
+    "memory_compaction": 60.0,
+}
+
+
+def call_site_tiers_from_env() -> dict:
+    """Builds the per-call-site model tiers.
+
+    For every call site ``X`` the environment may override the deadline
+    (``LLM_DEADLINE_X``, 0 disables hedging), the primary model
+    (``LLM_MODEL_X``) and the hedge model (``LLM_FALLBACK_MODEL_X``, empty
+    disables hedging).
+    """
+    tiers = {}
+    for call_site, deadline in DEFAULT_DEADLINES.items():
+        key = call_site.upper()
+        tiers[call_site] = {
+            "deadline": float(os.getenv(f'LLM_DEADLINE_{key}', deadline)),
+            "primary": os.getenv(f'LLM_MODEL_{key}', PRIMARY_MODEL),
+            "fallback": os.getenv(f'LLM_FALLBACK_MODEL_{key}', FAST_MODEL),
+        }
+    return tiers
+
+
+class LLMOverloaded(Exception):
+    """Raised when a request is shed because the gateway is saturated."""
+
+
+def estimate_tokens(contents) -> int:
+    """Cheap token estimate (about three characters per token for Arabic text)."""
+    if isinstance(contents, str):
+        size = len(contents)
+    else:
+        size = sum(len(part) for turn in contents for part in turn.get('parts', []) if isinstance(part, str))
+    return size // 3 + EXPECTED_OUTPUT_TOKENS
+
+
+def log_llm_usage(call_site, response, started):
+    usage = getattr(response, 'usage_metadata', None)
+    total_tokens = getattr(usage, 'total_token_count', None)
+    logger.info(f"LLM call [{call_site}] took {time.perf_counter() - started:.2f}s, tokens={total_tokens}")
+    return total_tokens
+
+
+class TokenBucket:
+    """Refills ``per_minute`` units per minute up to a burst of ``per_minute``."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until ``amount`` units are available (0 if available now)."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        self._refill()
+        self.tokens -= amount
+
+
+class LLMGateway:
+    def __init__(self, model_factory, max_concurrency: int = 8, requests_per_minute: int = 0,
+                 tokens_per_minute: int = 0, max_queue: int = 100, max_wait: dict = None,
+                 call_site_tiers: dict = None):
+        self.model_factory = model_factory
+        self.call_site_tiers = call_site_tiers or {}
+        self.answered_by = Counter()
+        self._models = {}
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = {**DEFAULT_MAX_WAIT, **(max_wait or {})}
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.running = 0
+        self.shed = 0
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._wakeup = None
+
+    def get_model(self, name: str = PRIMARY_MODEL):
+        model = self._models.get(name)
+        if model is None:
+            model = self.model_factory(name)
+            if model: # لا نحفظ فشل الإنشاء (مثل غياب المفتاح) حتى نعيد المحاولة لاحقاً
+                self._models[name] = model
+        return model
+
+    def model_for(self, call_site: str):
+        """The primary model configured for ``call_site`` (e.g. for streamed replies)."""
+        return self.get_model(self.call_site_tiers.get(call_site, {}).get("primary", PRIMARY_MODEL))
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for *_, future in self._waiters if not future.done())
+
+    def _wait_for_budget(self, estimated_tokens: int) -> float:
+        wait = 0.0
+        if self.request_bucket:
+            wait = max(wait, self.request_bucket.wait_time(1))
+        if self.token_bucket:
+            wait = max(wait, self.token_bucket.wait_time(estimated_tokens))
+        return wait
+
+    def _dispatch(self):
+        self._wakeup = None
+        while self._waiters and self.running < self.max_concurrency:
+            priority, _, estimated_tokens, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            wait = self._wait_for_budget(estimated_tokens)
+            if wait > 0:
+                self._wakeup = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+            heapq.heappop(self._waiters)
+            if self.request_bucket:
+                self.request_bucket.consume(1)
+            if self.token_bucket:
+                self.token_bucket.consume(estimated_tokens)
+            self.running += 1
+            future.set_result(None)
+
+    async def _acquire(self, priority: int, estimated_tokens: int):
+        if self.queue_depth >= self.max_queue:
+            self.shed += 1
+            raise LLMOverloaded(f"LLM queue is full ({self.max_queue} waiting)")
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), estimated_tokens, future))
+        if self._wakeup is None:
+            self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait[priority])
+        except asyncio.TimeoutError:
+            if not future.done():
+                future.cancel()
+                self.shed += 1
+                raise LLMOverloaded(f"Waited more than {self.max_wait[priority]}s for an LLM slot ({PRIORITY_NAMES[priority]})")
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()
+            else:
+                future.cancel()
+            raise
+
+    def _release(self, actual_tokens: int = None, estimated_tokens: int = 0):
+        self.running -= 1
+        if self.token_bucket and actual_tokens is not None:
+            # نصحح التقدير بالعدد الفعلي الذي أرجعه النموذج
+            self.token_bucket.consume(actual_tokens - estimated_tokens)
+        if self._wakeup is None:
+            self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, priority: int = INTERACTIVE, estimated_tokens: int = EXPECTED_OUTPUT_TOKENS):
+        """Holds one concurrency slot, e.g. for the whole life of a streamed reply."""
+        await self._acquire(priority, estimated_tokens)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _call(self, model_name: str, contents, call_site: str, priority: int, kwargs: dict, admitted=None):
+        estimated_tokens = estimate_tokens(contents)
+        await self._acquire(priority, estimated_tokens)
+        if admitted is not None and not admitted.done():
+            admitted.set_result(None)
+        actual_tokens = None
+        labels = {"call_site": call_site, "model": model_name}
+        try:
+            started = time.perf_counter()
+            response = await self.get_model(model_name).generate_content_async(contents, **kwargs)
+            actual_tokens = log_llm_usage(f"{call_site}/{model_name}", response, started)
+            metrics.histogram("llm_request_seconds", "Latency of LLM calls by call site and model.", labels).observe(time.perf_counter() - started)
+            if actual_tokens:
+                metrics.counter("llm_tokens_total", "Tokens used by LLM calls by call site and model.", labels).inc(actual_tokens)
+            return response
+        except Exception:
+            metrics.counter("llm_errors_total", "Failed LLM calls by call site and model.", labels).inc()
+            raise
+        finally:
+            self._release(actual_tokens, estimated_tokens)
+
+    def _answered(self, call_site: str, tier: str, response):
+        self.answered_by[(call_site, tier)] += 1
+        return response
+
+    async def generate(self, contents, call_site: str, priority: int = INTERACTIVE, **kwargs):
+        """Calls the call site's primary model, hedging to its fast model on a missed deadline."""
+        tier = self.call_site_tiers.get(call_site, {"deadline": 0, "primary": PRIMARY_MODEL, "fallback": None})
+        admitted = asyncio.get_running_loop().create_future()
+        primary = asyncio.ensure_future(self._call(tier["primary"], contents, call_site, priority, kwargs, admitted))
+        if not tier["deadline"] or not tier["fallback"] or tier["fallback"] == tier["primary"]:
+            return self._answered(call_site, "primary", await primary)
+
+        try:
+            # المهلة تبدأ بعد حصول الطلب على مكان، فالانتظار في الطابور لا يُحسب عليها
+            await asyncio.wait({primary, admitted}, return_when=asyncio.FIRST_COMPLETED)
+            done, _ = await asyncio.wait({primary}, timeout=tier["deadline"])
+            while not done and self.queue_depth > 0:
+                # طلبات أخرى تنتظر: الطلب الاحتياطي سيزيد الازدحام، فنكتفي بانتظار الأساسي
+                done, _ = await asyncio.wait({primary}, timeout=tier["deadline"])
+        except asyncio.CancelledError:
+            primary.cancel()
+            raise
+        if done and not primary.exception():
+            return self._answered(call_site, "primary", primary.result())
+        if done and isinstance(primary.exception(), LLMOverloaded):
+            raise primary.exception()
+
+        # تجاوز المهلة أو فشل النموذج الأساسي: نرسل طلباً احتياطياً للنموذج الأسرع
+        logger.info(f"LLM call [{call_site}] missed its {tier['deadline']}s deadline, hedging to {tier['fallback']}")
+        tiers = {primary: "primary"}
+        hedge = asyncio.ensure_future(self._call(tier["fallback"], contents, call_site, priority, kwargs))
+        tiers[hedge] = "fallback"
+        pending = {hedge} if done else {primary, hedge}
+        error = primary.exception() if done else None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return self._answered(call_site, tiers[task], task.result())
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
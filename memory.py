@@ -0,0 +1,162 @@
+# memory.py
+"""Bounded, hierarchical long-term memory stored inside a user record.
+
+Summaries of archived conversation turns land in the ``daily`` tier. When a
+tier outgrows its share of the byte budget, its oldest entries are compacted
+by the LLM into the next, coarser tier: daily -> weekly -> core facts. The
+prompt builder only ever receives ``build_memory_context`` output, which is
+guaranteed to fit ``budget_bytes``.
+"""
+import logging
+from datetime import date
+
+logger = logging.getLogger(__name__)
+
+MAX_DAILY_ENTRIES = 7
+MAX_WEEKLY_ENTRIES = 4
+
+# نسبة كل طبقة من الميزانية الكلية
+DAILY_SHARE = 0.4
+WEEKLY_SHARE = 0.3
+CORE_SHARE = 0.3
+
+COMPACT_PROMPTS = {
+    "daily": "ادمجي ملخصات الأيام التالية في ملخص أسبوعي واحد مختصر يحتفظ بالأحداث والمشاعر المهمة فقط:\n\n{text}",
+    "weekly": "ادمجي الملخصات الأسبوعية التالية مع الحقائق الأساسية الحالية في قائمة مختصرة من الحقائق الجوهرية عن صديقي:\n\n{text}",
+    "core": "اختصري قائمة الحقائق الجوهرية التالية إلى أهم النقاط فقط، في أقل من {limit} حرف:\n\n{text}",
+}
+
+
+def _size(text: str) -> int:
+    return len(text.encode('utf-8'))
+
+
+def _truncate(text: str, limit: int) -> str:
+    """Cuts text to at most ``limit`` UTF-8 bytes without splitting a character."""
+    if _size(text) <= limit:
+        return text
+    return text.encode('utf-8')[:max(limit, 0)].decode('utf-8', errors='ignore')
+
+
+def get_tiers(record: dict) -> dict:
+    """Returns the memory tiers of a record, migrating the legacy flat summary."""
+    tiers = record.get('memory_tiers')
+    if tiers is None:
+        tiers = {'daily': [], 'weekly': [], 'core': ""}
+        legacy_summary = record.pop('memory_summary', "").strip()
+        if legacy_summary:
+            tiers['daily'].append({'date': "legacy", 'text': legacy_summary})
+        record['memory_tiers'] = tiers
+    return tiers
+
+
+def add_summary(record: dict, text: str, today: date):
+    """Adds a fresh conversation summary to today's daily entry."""
+    daily = get_tiers(record)['daily']
+    day = today.isoformat()
+    if daily and daily[-1]['date'] == day:
+        daily[-1] = {'date': day, 'text': daily[-1]['text'] + "\n" + text.strip()}
+    else:
+        daily.append({'date': day, 'text': text.strip()})
+
+
+def tier_to_compact(record: dict, budget_bytes: int):
+    """Returns the name of the tier that is over its limit, or None."""
+    tiers = get_tiers(record)
+    if len(tiers['daily']) > MAX_DAILY_ENTRIES or sum(_size(e['text']) for e in tiers['daily']) > budget_bytes * DAILY_SHARE:
+        return 'daily'
+    if len(tiers['weekly']) > MAX_WEEKLY_ENTRIES or sum(_size(e['text']) for e in tiers['weekly']) > budget_bytes * WEEKLY_SHARE:
+        if tiers['weekly']:
+            return 'weekly'
+    if _size(tiers['core']) > budget_bytes * CORE_SHARE:
+        return 'core'
+    return None
+
+
+async def compact_tiers(record: dict, budget_bytes: int, summarize, max_rounds: int = 3):
+    """Compacts over-budget tiers using ``summarize(prompt) -> text``.
+
+    All LLM calls happen before the tiers are touched, and each swap is done
+    without awaiting, so concurrent readers only ever see a consistent state.
+    """
+    for _ in range(max_rounds):
+        tier = tier_to_compact(record, budget_bytes)
+        if tier is None:
+            return
+        tiers = get_tiers(record)
+
+        if tier == 'daily' and len(tiers['daily']) == 1:
+            # يوم واحد طويل جداً: نعيد تلخيصه في مكانه
+            entry = tiers['daily'][0]
+            limit = int(budget_bytes * DAILY_SHARE)
+            text = await summarize(COMPACT_PROMPTS['core'].format(text=entry['text'], limit=limit // 4))
+            if tiers['daily'] != [entry]:
+                return
+            tiers['daily'] = [{'date': entry['date'], 'text': _truncate(text.strip(), limit)}]
+        elif tier == 'daily':
+            # نبقي آخر يوم كما هو وندمج ما قبله في ملخص أسبوعي
+            batch = tiers['daily'][:-1]
+            text = await summarize(COMPACT_PROMPTS['daily'].format(text="\n\n".join(f"[{e['date']}]\n{e['text']}" for e in batch)))
+            if tiers['daily'][:len(batch)] != batch:
+                return
+            tiers['weekly'].append({'week': batch[-1]['date'], 'text': text.strip()})
+            tiers['daily'] = tiers['daily'][len(batch):]
+        elif tier == 'weekly':
+            batch = list(tiers['weekly'])
+            core = tiers['core']
+            text = await summarize(COMPACT_PROMPTS['weekly'].format(text=core + "\n\n" + "\n\n".join(e['text'] for e in batch)))
+            if tiers['weekly'][:len(batch)] != batch or tiers['core'] != core:
+                return
+            tiers['core'] = text.strip()
+            tiers['weekly'] = tiers['weekly'][len(batch):]
+        else:
+            core = tiers['core']
+            limit = int(budget_bytes * CORE_SHARE)
+            text = await summarize(COMPACT_PROMPTS['core'].format(text=core, limit=limit // 2))
+            if tiers['core'] != core:
+                return
+            tiers['core'] = _truncate(text.strip(), limit)
+        logger.info(f"Compacted '{tier}' memory tier.")
+
+
+def build_memory_context(record: dict, budget_bytes: int, snippets: list[str] = None) -> str:
+    """Builds the prompt memory section, guaranteed to fit ``budget_bytes``.
+
+    Core facts come first, then the newest weekly and daily summaries that
+    still fit; older entries are left out rather than overflowing the budget.
+    When retrieval ``snippets`` are given they replace the full facts list.
+    """
+    tiers = get_tiers(record)
+    if snippets is None:
+        facts = record.get('memory', {})
+        facts_text = "\n".join(f"- {k}: {v}" for k, v in facts.items())
+        facts_header = "\n\nأشياء أعرفها عنك:\n"
+    else:
+        facts_text = "\n".join(f"- {snippet}" for snippet in snippets)
+        facts_header = "\n\nذكريات وأشياء أعرفها عنك لها علاقة بالرسالة الحالية:\n"
+
+    header = "ملخص محادثاتنا السابقة:\n"
+    remaining = budget_bytes - _size(header) - _size(facts_header)
+
+    facts_text = _truncate(facts_text, remaining // 3)
+    remaining -= _size(facts_text)
+
+    core = _truncate(tiers['core'], remaining)
+    remaining -= _size(core)
+
+    # نختار الأحدث أولاً ثم نعيد الترتيب زمنياً
+    selected = []
+    for entry in reversed(tiers['weekly'] + tiers['daily']):
+        cost = _size(entry['text']) + 1
+        if cost > remaining:
+            if not selected and remaining > 1:
+                # لا مكان لأحدث ملخص كاملاً: نأخذ نهايته لأنها الأحدث
+                tail = entry['text'].encode('utf-8')[-(remaining - 1):].decode('utf-8', errors='ignore')
+                selected.append(tail)
+            break
+        selected.append(entry['text'])
+        remaining -= cost
+    summary_parts = [core] if core else []
+    summary_parts.extend(reversed(selected))
+
+    return _truncate(header + "\n".join(summary_parts) + facts_header + facts_text, budget_bytes)
@@ -0,0 +1,141 @@
+# metrics.py
+"""In-process metrics rendered in the Prometheus text format.
+
+Histograms and counters are plain Python objects guarded by a lock, cheap
+enough to stay enabled in production. Values owned by other components
+(queue depths, hit counters) are read lazily at scrape time through
+``register_collector``. ``render_prometheus`` produces the ``/metrics`` body.
+"""
+import bisect
+import functools
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_lock = threading.Lock()
+_families = {}
+_collectors = []
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((labels or {}).items()))
+
+
+def _format_labels(key: tuple, extra: tuple = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram, cheap enough for the hot path."""
+
+    def __init__(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self, key: tuple):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            yield f"{self.name}_bucket{_format_labels(key, (('le', le),))} {cumulative}"
+        yield f"{self.name}_sum{_format_labels(key)} {self.sum!r}"
+        yield f"{self.name}_count{_format_labels(key)} {self.count}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, key: tuple):
+        yield f"{self.name}{_format_labels(key)} {_format_value(self.value)}"
+
+
+def _get(kind: str, cls, name: str, help_text: str, labels: dict, **kwargs):
+    key = _label_key(labels)
+    family = _families.get(name)
+    if family is None or key not in family[2]:
+        with _lock:
+            family = _families.setdefault(name, (kind, help_text, {}))
+            if key not in family[2]:
+                family[2][key] = cls(name, help_text, **kwargs)
+    return family[2][key]
+
+
+def histogram(name: str, help_text: str = "", labels: dict = None, buckets=DEFAULT_BUCKETS) -> Histogram:
+    """Returns the histogram registered under ``name`` and ``labels``, creating it on first use."""
+    return _get("histogram", Histogram, name, help_text, labels, buckets=buckets)
+
+
+def counter(name: str, help_text: str = "", labels: dict = None) -> Counter:
+    """Returns the counter registered under ``name`` and ``labels``, creating it on first use."""
+    return _get("counter", Counter, name, help_text, labels)
+
+
+def register_collector(name: str, help_text: str, kind: str, collect):
+    """Registers a metric whose samples are read at scrape time.
+
+    ``collect`` returns an iterable of ``(labels_dict, value)`` pairs and
+    ``kind`` is the Prometheus type (``gauge`` or ``counter``).
+    """
+    _collectors.append((name, help_text, kind, collect))
+
+
+def track_latency(name: str, help_text: str = "", **labels):
+    """Decorator that records the run time of an async function in a histogram."""
+    def decorator(func):
+        metric = histogram(name, help_text, labels)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                metric.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def render_prometheus() -> str:
+    lines = []
+    for name, (kind, help_text, series) in sorted(_families.items()):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for key, metric in sorted(series.items()):
+            lines.extend(metric.samples(key))
+    for name, help_text, kind, collect in _collectors:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in collect():
+            lines.append(f"{name}{_format_labels(_label_key(labels))} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
@@ -0,0 +1,235 @@
+# reminders.py
+"""Durable reminder scheduling.
+
+Reminders are stored in SQLite, indexed by due time, so they survive restarts.
+A single asyncio loop keeps only the reminders due within ``horizon`` seconds
+in a min-heap, delivers due reminders in batches through the bot's
+``reminder_callback`` and marks the successful sends delivered in one
+transaction. Sends are throttled to ``max_per_second`` to stay under
+Telegram's flood limit; a failed send stays pending and is retried with
+exponential backoff (or after Telegram's ``retry_after``), up to
+``max_attempts`` times. Reminders that came due while the bot was down are
+delivered on the first pass after startup.
+"""
+import asyncio
+import heapq
+import json
+import logging
+import sqlite3
+import threading
+import time
+from datetime import timedelta
+
+logger = logging.getLogger(__name__)
+
+
+class ReminderStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS reminders (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id TEXT NOT NULL,
+                    due_at REAL NOT NULL,
+                    data TEXT NOT NULL,
+                    delivered_at REAL
+                )
+            """)
+            # فهرس جزئي: التذكيرات المعلقة فقط، مرتبة حسب موعدها
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_reminders_pending_due ON reminders (due_at) WHERE delivered_at IS NULL")
+            self._conn.commit()
+
+    def add(self, chat_id, due_at: float, data: dict) -> int:
+        with self._lock:
+            with self._conn:
+                return self._conn.execute(
+                    "INSERT INTO reminders (chat_id, due_at, data) VALUES (?, ?, ?)",
+                    (str(chat_id), due_at, json.dumps(data, ensure_ascii=False))
+                ).lastrowid
+
+    def pending_until(self, until: float, limit: int) -> list[tuple]:
+        """Returns up to ``limit`` undelivered (id, chat_id, due_at, data) rows due before ``until``."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, chat_id, due_at, data FROM reminders WHERE delivered_at IS NULL AND due_at <= ? ORDER BY due_at LIMIT ?",
+                (until, limit)
+            ).fetchall()
+        return [(reminder_id, chat_id, due_at, json.loads(data)) for reminder_id, chat_id, due_at, data in rows]
+
+    def mark_delivered(self, reminder_ids, delivered_at: float):
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(
+                    "UPDATE reminders SET delivered_at = ? WHERE id = ?",
+                    [(delivered_at, reminder_id) for reminder_id in reminder_ids]
+                )
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM reminders WHERE delivered_at IS NULL").fetchone()[0]
+
+
+class ReminderJob:
+    """The ``context.job`` seen by the delivery hook, shaped like a PTB Job."""
+
+    __slots__ = ("id", "chat_id", "data", "name")
+
+    def __init__(self, reminder_id, chat_id, data):
+        self.id = reminder_id
+        self.chat_id = chat_id
+        self.data = data
+        self.name = f"reminder_{reminder_id}"
+
+
+class ReminderContext:
+    """Minimal callback context handed to ``reminder_callback``."""
+
+    __slots__ = ("application", "bot", "job")
+
+    def __init__(self, application, job: ReminderJob):
+        self.application = application
+        self.bot = application.bot
+        self.job = job
+
+
+class ReminderScheduler:
+    def __init__(self, store: ReminderStore, callback, horizon: float = 300.0,
+                 batch_size: int = 100, max_loaded: int = 10000, max_per_second: int = 25,
+                 max_attempts: int = 5, retry_base: float = 5.0, retry_max: float = 600.0):
+        self.store = store
+        self.callback = callback
+        self.horizon = horizon
+        self.batch_size = batch_size
+        self.max_loaded = max_loaded
+        self.max_per_second = max_per_second
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._heap = []
+        self._scheduled = set()
+        self._attempts = {}
+        self._loaded_until = 0.0
+        self._wakeup = asyncio.Event()
+        self._application = None
+        self._task = None
+
+    @property
+    def depth(self) -> int:
+        """Number of reminders currently held in memory."""
+        return len(self._heap)
+
+    async def _in_thread(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def schedule(self, chat_id, delay: float, data: dict) -> int:
+        due_at = time.time() + delay
+        reminder_id = await self._in_thread(self.store.add, chat_id, due_at, data)
+        if due_at <= self._loaded_until and reminder_id not in self._scheduled:
+            heapq.heappush(self._heap, (due_at, reminder_id, str(chat_id), data))
+            self._scheduled.add(reminder_id)
+            self._wakeup.set()
+        return reminder_id
+
+    async def _refill(self, now: float):
+        until = now + self.horizon
+        rows = await self._in_thread(self.store.pending_until, until, self.max_loaded)
+        for reminder_id, chat_id, due_at, data in rows:
+            if reminder_id not in self._scheduled:
+                heapq.heappush(self._heap, (due_at, reminder_id, chat_id, data))
+                self._scheduled.add(reminder_id)
+        # إذا امتلأت النافذة نحمّل فقط حتى آخر تذكير قرأناه
+        self._loaded_until = rows[-1][2] if len(rows) >= self.max_loaded else until
+
+    def _retry_delay(self, reminder_id, error) -> float:
+        # RetryAfter من تيليجرام يحدد المدة بنفسه، وإلا فتراجع أسي
+        retry_after = getattr(error, "retry_after", None)
+        if isinstance(retry_after, timedelta):
+            return retry_after.total_seconds()
+        if retry_after is not None:
+            return float(retry_after)
+        return min(self.retry_max, self.retry_base * 2 ** (self._attempts[reminder_id] - 1))
+
+    async def _deliver(self, batch):
+        async def deliver_one(reminder_id, chat_id, data):
+            try:
+                await self.callback(ReminderContext(self._application, ReminderJob(reminder_id, chat_id, data)))
+                return None
+            except Exception as e:
+                logger.error(f"Failed to deliver reminder {reminder_id} to {chat_id}: {e}")
+                return e
+
+        delivered, retries = [], []
+        pause = 0.0
+        for start in range(0, len(batch), self.max_per_second):
+            chunk = batch[start:start + self.max_per_second]
+            if pause:
+                # تيليجرام طلب التوقف: ما لم يُرسل بعد ينتظر معه
+                retries.extend((pause, item) for item in chunk)
+                continue
+            started = time.monotonic()
+            errors = await asyncio.gather(*(deliver_one(reminder_id, chat_id, data) for _, reminder_id, chat_id, data in chunk))
+            for item, error in zip(chunk, errors):
+                reminder_id = item[1]
+                if error is None:
+                    delivered.append(reminder_id)
+                    continue
+                self._attempts[reminder_id] = self._attempts.get(reminder_id, 0) + 1
+                if self._attempts[reminder_id] >= self.max_attempts:
+                    logger.error(f"Giving up on reminder {reminder_id} after {self._attempts[reminder_id]} attempts")
+                    delivered.append(reminder_id)
+                    continue
+                delay = self._retry_delay(reminder_id, error)
+                if getattr(error, "retry_after", None) is not None:
+                    pause = max(pause, delay)
+                retries.append((delay, item))
+            if not pause:
+                # حتى بين الدفعات المتتالية لا نتجاوز الحد في الثانية
+                await asyncio.sleep(max(0.0, 1.0 - (time.monotonic() - started)))
+
+        if delivered:
+            await self._in_thread(self.store.mark_delivered, delivered, time.time())
+        for reminder_id in delivered:
+            self._scheduled.discard(reminder_id)
+            self._attempts.pop(reminder_id, None)
+        # الفاشلة تبقى معلقة في القاعدة وتعود إلى الكومة بموعد لاحق
+        now = time.time()
+        for delay, (_, reminder_id, chat_id, data) in retries:
+            heapq.heappush(self._heap, (now + delay, reminder_id, chat_id, data))
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            if now >= self._loaded_until - 1:
+                await self._refill(now)
+
+            batch = []
+            while self._heap and self._heap[0][0] <= now and len(batch) < self.batch_size:
+                batch.append(heapq.heappop(self._heap))
+            if batch:
+                await self._deliver(batch)
+                continue
+
+            next_due = self._heap[0][0] if self._heap else self._loaded_until
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(0.0, min(next_due, self._loaded_until) - now))
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, application):
+        self._application = application
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,129 @@
+# response_cache.py
+"""TTL + LRU cache for model answers that do not depend on who asked.
+
+Answers are keyed on the intent and the normalized query (the same Arabic
+normalization the retrieval index uses), expire after ``ttl`` seconds and are
+evicted least-recently-used first once the cache holds more than
+``max_entries`` answers or ``max_bytes`` of text. The requesting user's name
+is swapped for a placeholder before storing, so a hit is personalized with
+the next user's name instead of being regenerated. With ``path`` set the
+cache is saved to and reloaded from a JSON file.
+"""
+import json
+import logging
+import os
+import re
+import time
+from collections import Counter, OrderedDict
+
+from retrieval import tokenize
+
+logger = logging.getLogger(__name__)
+
+NAME_PLACEHOLDER = "\u2063{user_name}\u2063" # محاط بفاصل غير مرئي حتى لا يطابق نصاً عادياً
+
+
+def cache_key(intent: str, query: str) -> str | None:
+    """``intent:normalized query``, or None when nothing is left to key on."""
+    tokens = tokenize(query)
+    return f"{intent}:{' '.join(tokens)}" if tokens else None
+
+
+def depersonalize(text: str, user_name: str) -> str:
+    if not user_name or len(user_name) < 2:
+        return text
+    # الاسم ككلمة كاملة فقط، حتى لا يُستبدل "Ali" داخل "quality" مثلاً،
+    # مع السوابق العربية الملتصقة به (و، ف، ب، ل، ك) كما في "لأحمد" و"وبأحمد"
+    pattern = rf"(?<!\w)([وفبلك]{{0,2}}){re.escape(user_name)}(?!\w)"
+    return re.sub(pattern, lambda match: match.group(1) + NAME_PLACEHOLDER, text)
+
+
+def mentions_name(text: str, user_name: str) -> bool:
+    """Whether ``user_name`` still appears anywhere in ``text`` outside the placeholder."""
+    if not user_name or len(user_name) < 2:
+        return False
+    return user_name in text.replace(NAME_PLACEHOLDER, "")
+
+
+def personalize(text: str, user_name: str) -> str:
+    return text.replace(NAME_PLACEHOLDER, user_name)
+
+
+class ResponseCache:
+    def __init__(self, ttl: float = 6 * 3600, max_entries: int = 1000, max_bytes: int = 4 * 1024 * 1024, path: str = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = path
+        self.stats = Counter()
+        self._entries = OrderedDict() # key -> (expires_at, text)
+        self._bytes = 0
+        if path:
+            self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self) -> int:
+        return self._bytes
+
+    def hit_rate(self) -> float:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0.0
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        if entry[0] <= time.time():
+            self._remove(key)
+            self.stats["expired"] += 1
+            self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry[1]
+
+    def put(self, key: str, text: str, expires_at: float = None):
+        if key in self._entries:
+            self._remove(key)
+        size = len(text.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (expires_at or time.time() + self.ttl, text)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.stats["evictions"] += 1
+
+    def _remove(self, key: str):
+        _, text = self._entries.pop(key)
+        self._bytes -= len(text.encode('utf-8'))
+
+    def save(self):
+        """Writes the live entries to ``path`` (atomically, via a temporary file)."""
+        if not self.path:
+            return
+        now = time.time()
+        entries = [[key, expires_at, text] for key, (expires_at, text) in self._entries.items() if expires_at > now]
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f"Could not load response cache from {self.path}: {e}")
+            return
+        now = time.time()
+        for key, expires_at, text in entries: # بترتيب الاستخدام، الأحدث في النهاية
+            if expires_at > now:
+                self.put(key, text, expires_at)
+        logger.info(f"Loaded {len(self._entries)} cached responses from {self.path}")
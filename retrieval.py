@@ -0,0 +1,140 @@
+# retrieval.py
+"""Local BM25 retrieval over a user's archived conversation turns and facts.
+
+Nothing leaves the process: texts are normalized and tokenized here, and each
+user gets an in-memory inverted index that is built from the archive table
+once and then updated incrementally as new turns are archived.
+"""
+import asyncio
+import logging
+import math
+import re
+from collections import Counter, OrderedDict
+
+logger = logging.getLogger(__name__)
+
+_DIACRITICS_RE = re.compile(r"[\u064B-\u065F\u0670\u0640]")
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+_CHAR_MAP = str.maketrans({"أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا", "ة": "ه", "ى": "ي", "ؤ": "و", "ئ": "ي"})
+_PREFIXES = ("وال", "بال", "كال", "فال", "لل", "ال")
+
+STOP_WORDS = {
+    "في", "من", "علي", "الي", "عن", "مع", "هذا", "هذه", "ذلك", "تلك", "هو", "هي", "انا", "انت", "انتي",
+    "نحن", "هم", "كان", "كانت", "ما", "ماذا", "لا", "لم", "لن", "ان", "او", "ثم", "قد", "هل", "كل", "يا",
+    "the", "a", "an", "and", "or", "of", "to", "in", "on", "is", "are", "was", "i", "you", "it", "my", "me",
+}
+
+
+def tokenize(text: str) -> list[str]:
+    text = _DIACRITICS_RE.sub("", text or "").translate(_CHAR_MAP).lower()
+    tokens = []
+    for token in _TOKEN_RE.findall(text):
+        for prefix in _PREFIXES:
+            if token.startswith(prefix) and len(token) - len(prefix) >= 2:
+                token = token[len(prefix):]
+                break
+        if len(token) > 1 and token not in STOP_WORDS:
+            tokens.append(token)
+    return tokens
+
+
+class BM25Index:
+    """Incremental Okapi BM25 index with an inverted posting list."""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.texts = {}
+        self.lengths = {}
+        self.postings = {}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.texts)
+
+    def add(self, doc_id, text: str):
+        if doc_id in self.texts:
+            return
+        term_counts = Counter(tokenize(text))
+        self.texts[doc_id] = text
+        self.lengths[doc_id] = sum(term_counts.values())
+        self.total_length += self.lengths[doc_id]
+        for term, count in term_counts.items():
+            self.postings.setdefault(term, {})[doc_id] = count
+
+    def search(self, query: str, k: int = 4) -> list[str]:
+        """Returns the texts of the ``k`` best matching documents."""
+        if not self.texts:
+            return []
+        doc_count = len(self.texts)
+        average_length = self.total_length / doc_count or 1
+        scores = Counter()
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (doc_count - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_id, count in posting.items():
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[doc_id] / average_length)
+                scores[doc_id] += idf * count * (self.k1 + 1) / (count + norm)
+        return [self.texts[doc_id] for doc_id, _ in scores.most_common(k)]
+
+
+class ConversationIndex:
+    """Per-user BM25 indexes backed by the archive table of a ``UserStore``.
+
+    Indexes are loaded lazily on first use and kept in an LRU of at most
+    ``max_users`` entries; archiving a turn writes it to the store and adds
+    it to the user's index if that index is resident.
+    """
+
+    def __init__(self, store, max_users: int = 1000):
+        self.store = store
+        self.max_users = max_users
+        self._indexes = OrderedDict()
+        self._loading = {} # user_id -> مهمة التحميل الجارية، يشترك فيها كل من ينتظر نفس الفهرس
+
+    async def _load(self, user_id: str) -> BM25Index:
+        try:
+            rows = await asyncio.get_running_loop().run_in_executor(None, self.store.load_archive, user_id)
+            index = BM25Index()
+            for doc_id, _, text in rows:
+                index.add(doc_id, text)
+            self._indexes[user_id] = index
+            while len(self._indexes) > self.max_users:
+                self._indexes.popitem(last=False)
+            return index
+        finally:
+            del self._loading[user_id]
+
+    async def _get_index(self, user_id: str) -> BM25Index:
+        index = self._indexes.get(user_id)
+        if index is None:
+            loading = self._loading.get(user_id)
+            if loading is None:
+                loading = self._loading[user_id] = asyncio.ensure_future(self._load(user_id))
+            index = await asyncio.shield(loading)
+        if user_id in self._indexes:
+            self._indexes.move_to_end(user_id)
+        return index
+
+    async def archive(self, user_id, kind: str, texts: list[str]):
+        user_id = str(user_id)
+        texts = [text for text in texts if text and text.strip()]
+        if not texts:
+            return
+        doc_ids = await asyncio.get_running_loop().run_in_executor(None, self.store.add_archive, user_id, kind, texts)
+        loading = self._loading.get(user_id)
+        if loading is not None:
+            # التحميل الجاري ربما قرأ الأرشيف قبل هذه الكتابة، فننتظره ثم نضيف إليه (الإضافة لا تكرر)
+            await asyncio.shield(loading)
+        index = self._indexes.get(user_id)
+        if index is not None:
+            for doc_id, text in zip(doc_ids, texts):
+                index.add(doc_id, text)
+
+    async def search(self, user_id, query: str, k: int = 4) -> list[str]:
+        if not query:
+            return []
+        index = await self._get_index(str(user_id))
+        return index.search(query, k)
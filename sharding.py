@@ -0,0 +1,474 @@
+# sharding.py
+"""Sharded deployment: one ingress process routes updates to N bot workers.
+
+The ingress receives Telegram's webhook and forwards each update to the
+worker that owns its user, chosen by a stable hash of the user id. Every
+worker is an ordinary ``bot.py`` process in webhook mode listening on a
+local port, with its own user-state and reminder databases, so a slow turn
+or a large write in one worker never stalls users of another.
+
+Per-user ordering holds because each worker is fed by a single in-order
+sender and the worker's ``UserDispatcher`` serializes turns per user. When a
+worker dies the ingress restarts it and keeps retrying that worker's queued
+updates, while the other workers carry on. Delivery is at-least-once only
+until a worker accepts an update: the worker acks as soon as the update is
+in PTB's in-memory ``update_queue``, so updates it has accepted but not yet
+handled are lost if it dies.
+
+    python sharding.py ingress --workers 4                # ingress + 4 supervised workers
+    python sharding.py ingress --workers 4 --no-spawn     # ingress only, workers run separately
+    python sharding.py worker --index 2 --count 4         # (re)start one worker by hand
+    python sharding.py selftest --workers 3               # local multi-process test
+
+Workers started by hand must share the ingress's ``SHARD_SECRET``.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import secrets
+import shutil
+import signal
+import sqlite3
+import sys
+import tempfile
+import time
+import zlib
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, web
+
+import metrics
+from webhook_server import HOME_TEXT, SECRET_HEADER, fake_update
+
+logger = logging.getLogger(__name__)
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+WORKER_PATH = "shard"
+RESTART_BACKOFF = (1.0, 2.0, 5.0, 10.0, 30.0)
+
+
+def shard_for(user_id, count: int) -> int:
+    """Stable shard index for a user (``hash()`` differs between processes)."""
+    return zlib.crc32(str(user_id).encode('utf-8')) % count
+
+
+def update_user_id(update: dict):
+    """The id of the user an update belongs to, or None for updates without one."""
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        sender = value.get("from") or value.get("user") or value.get("chat")
+        if isinstance(sender, dict) and "id" in sender:
+            return sender["id"]
+    return None
+
+
+def shard_paths(index: int, user_state_db: str = "user_state.db", reminders_db: str = "reminders.db") -> tuple[str, str]:
+    def with_suffix(path):
+        root, ext = os.path.splitext(path)
+        return f"{root}.shard{index}{ext}"
+    return with_suffix(user_state_db), with_suffix(reminders_db)
+
+
+def shard_env(index: int, count: int, base_port: int, secret: str) -> dict:
+    """Environment for worker ``index``; everything else is inherited from the ingress."""
+    user_state_db, reminders_db = shard_paths(
+        index, os.getenv('USER_STATE_DB', "user_state.db"), os.getenv('REMINDERS_DB', "reminders.db")
+    )
+    return {
+        'DEPLOY_MODE': "webhook",
+        'WEBHOOK_HOST': "127.0.0.1",
+        'PORT': str(base_port + index),
+        'WEBHOOK_PATH': WORKER_PATH,
+        'WEBHOOK_SECRET': secret,
+        'WEBHOOK_URL': "", # العامل لا يسجل webhook لدى تيليجرام، الـ ingress يفعل ذلك
+        'USER_STATE_DB': user_state_db,
+        'REMINDERS_DB': reminders_db,
+        'SHARD_INDEX': str(index),
+        'SHARD_COUNT': str(count),
+    }
+
+
+def split_state(count: int, user_state_db: str = "user_state.db", reminders_db: str = "reminders.db") -> int:
+    """One-time split of the single-process databases into per-shard databases.
+
+    Runs only when the shared databases exist and no shard database does;
+    afterwards they are renamed to ``<name>.sharded``. Returns the number of
+    users moved.
+    """
+    from reminders import ReminderStore
+    from storage import UserStore
+
+    targets = [shard_paths(i, user_state_db, reminders_db) for i in range(count)]
+    if any(os.path.exists(path) for pair in targets for path in pair):
+        return 0
+
+    moved = 0
+    if os.path.exists(user_state_db):
+        stores = [UserStore(user_path) for user_path, _ in targets]
+        source = sqlite3.connect(user_state_db)
+        rows = source.execute("SELECT user_id, data FROM user_state").fetchall()
+        for i, store in enumerate(stores):
+            store.write_rows([row for row in rows if shard_for(row[0], count) == i])
+        archive = {}
+        for user_id, kind, text in source.execute("SELECT user_id, kind, text FROM user_archive ORDER BY id"):
+            archive.setdefault((user_id, kind), []).append(text)
+        for (user_id, kind), texts in archive.items():
+            stores[shard_for(user_id, count)].add_archive(user_id, kind, texts)
+        source.close()
+        for store in stores:
+            store.close()
+        os.replace(user_state_db, user_state_db + ".sharded")
+        moved = len(rows)
+
+    if os.path.exists(reminders_db):
+        stores = [ReminderStore(reminders_path) for _, reminders_path in targets]
+        source = sqlite3.connect(reminders_db)
+        for chat_id, due_at, data in source.execute("SELECT chat_id, due_at, data FROM reminders WHERE delivered_at IS NULL"):
+            stores[shard_for(chat_id, count)].add(chat_id, due_at, json.loads(data))
+        source.close()
+        os.replace(reminders_db, reminders_db + ".sharded")
+
+    logger.info(f"Split {moved} users into {count} shards")
+    return moved
+
+
+class WorkerLink:
+    """Forwards one worker's updates in arrival order, retrying until accepted."""
+
+    def __init__(self, index: int, url: str, secret: str, max_queue: int = 10000):
+        self.index = index
+        self.url = url
+        self.secret = secret
+        self.queue = asyncio.Queue(max_queue)
+        self.forwarded = 0
+        self._task = None
+
+    def start(self, session: ClientSession):
+        self._task = asyncio.get_running_loop().create_task(self._run(session))
+
+    async def _run(self, session: ClientSession):
+        while True:
+            update = await self.queue.get()
+            await self._deliver(session, update)
+            self.forwarded += 1
+
+    async def _deliver(self, session: ClientSession, update: dict):
+        attempt = 0
+        while True:
+            try:
+                async with session.post(self.url, json=update, headers={SECRET_HEADER: self.secret}) as response:
+                    if response.status < 400:
+                        return
+                    if response.status == 400:
+                        logger.warning(f"Shard {self.index} rejected update {update.get('update_id')}, dropping it")
+                        return
+                    error = f"HTTP {response.status}"
+            except (ClientError, asyncio.TimeoutError, OSError) as e:
+                error = e
+            # العامل متوقف أو يعيد التشغيل: نعيد المحاولة بنفس الترتيب حتى يعود
+            delay = RESTART_BACKOFF[min(attempt, len(RESTART_BACKOFF) - 1)] / 2
+            if attempt == 0:
+                logger.warning(f"Shard {self.index} unreachable ({error}), retrying")
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class WorkerProcess:
+    """Keeps one worker process running, restarting it with backoff when it exits."""
+
+    def __init__(self, index: int, command: list[str], env: dict):
+        self.index = index
+        self.command = command
+        self.env = env
+        self.process = None
+        self.restarts = 0
+        self._stopping = False
+        self._task = None
+
+    async def _spawn(self):
+        self.process = await asyncio.create_subprocess_exec(*self.command, env={**os.environ, **self.env})
+        logger.info(f"Started shard {self.index} worker (pid {self.process.pid})")
+
+    async def _supervise(self):
+        attempt = 0
+        while not self._stopping:
+            started = time.monotonic()
+            await self._spawn()
+            code = await self.process.wait()
+            if self._stopping:
+                return
+            # إذا عاش العامل فترة كافية نبدأ مهلة إعادة التشغيل من جديد
+            attempt = 0 if time.monotonic() - started > 60 else attempt + 1
+            delay = RESTART_BACKOFF[min(attempt, len(RESTART_BACKOFF) - 1)]
+            self.restarts += 1
+            logger.error(f"Shard {self.index} worker exited with code {code}, restarting in {delay}s")
+            await asyncio.sleep(delay)
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._supervise())
+
+    async def stop(self):
+        self._stopping = True
+        if self.process and self.process.returncode is None:
+            self.process.terminate()
+            try:
+                await asyncio.wait_for(self.process.wait(), 15)
+            except asyncio.TimeoutError:
+                self.process.kill()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+def create_ingress_app(links: list[WorkerLink], url_path: str, secret_token: str = None) -> web.Application:
+    async def home(request):
+        return web.Response(text=HOME_TEXT)
+
+    async def metrics_endpoint(request):
+        return web.Response(body=metrics.render_prometheus().encode('utf-8'), headers={"Content-Type": metrics.PROMETHEUS_CONTENT_TYPE})
+
+    async def telegram_update(request):
+        if secret_token and request.headers.get(SECRET_HEADER) != secret_token:
+            return web.Response(status=403)
+        try:
+            update = await request.json()
+        except (json.JSONDecodeError, ValueError) as e:
+            logger.warning(f"Rejected malformed webhook update: {e}")
+            return web.Response(status=400)
+        user_id = update_user_id(update)
+        link = links[shard_for(user_id, len(links)) if user_id is not None else 0]
+        try:
+            link.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # تيليجرام يعيد إرسال التحديث لاحقاً عند رد غير ناجح
+            return web.Response(status=503)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_get("/", home)
+    app.router.add_get("/metrics", metrics_endpoint)
+    app.router.add_post(f"/{url_path.strip('/')}", telegram_update)
+    return app
+
+
+async def run_ingress(count: int, host: str, port: int, url_path: str, webhook_url: str = None,
+                      secret_token: str = None, token: str = None, base_port: int = None,
+                      spawn_workers: bool = True, worker_command: list[str] = None, ready=None, stop=None):
+    """Runs the ingress (and, unless ``spawn_workers`` is false, its workers) until SIGINT/SIGTERM.
+
+    ``ready`` is set once updates are accepted and setting ``stop`` shuts the
+    ingress down; both are optional events used by the self-test.
+    """
+    base_port = base_port or port + 1
+    internal_secret = os.getenv('SHARD_SECRET') or secrets.token_urlsafe(24)
+    links = [WorkerLink(i, f"http://127.0.0.1:{base_port + i}/{WORKER_PATH}", internal_secret) for i in range(count)]
+    workers = [WorkerProcess(i, worker_command or [sys.executable, BOT_SCRIPT], shard_env(i, count, base_port, internal_secret)) for i in range(count)]
+
+    metrics.register_collector("shard_queue_depth", "Updates waiting to be forwarded to each shard.", "gauge", lambda: [
+        ({"shard": str(link.index)}, link.queue.qsize()) for link in links
+    ])
+    metrics.register_collector("shard_forwarded_total", "Updates forwarded to each shard.", "counter", lambda: [
+        ({"shard": str(link.index)}, link.forwarded) for link in links
+    ])
+    metrics.register_collector("shard_restarts_total", "Worker restarts per shard.", "counter", lambda: [
+        ({"shard": str(worker.index)}, worker.restarts) for worker in workers
+    ])
+
+    if stop is None:
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                pass
+
+    if spawn_workers:
+        for worker in workers:
+            worker.start()
+    runner = web.AppRunner(create_ingress_app(links, url_path, secret_token))
+    async with ClientSession(timeout=ClientTimeout(total=30)) as session:
+        for link in links:
+            link.start(session)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logger.info(f"Ingress listening on {host}:{port}/{url_path.strip('/')} with {count} shards")
+        if webhook_url and token:
+            from telegram import Bot, Update
+            async with Bot(token) as bot:
+                await bot.set_webhook(
+                    url=f"{webhook_url.rstrip('/')}/{url_path.strip('/')}",
+                    secret_token=secret_token,
+                    allowed_updates=Update.ALL_TYPES
+                )
+        if ready is not None:
+            ready.set()
+        try:
+            await stop.wait()
+        finally:
+            await runner.cleanup()
+            for link in links:
+                await link.stop()
+            for worker in workers:
+                await worker.stop()
+    return workers
+
+
+# --- اختبار محلي متعدد العمليات: عمال صدى يسجلون ما يصلهم بالترتيب ---
+def run_echo_worker(log_path: str):
+    """Test worker: accepts forwarded updates like a bot worker and appends them to ``log_path``."""
+    secret = os.environ['WEBHOOK_SECRET']
+    shard = int(os.environ['SHARD_INDEX'])
+
+    async def receive(request):
+        if request.headers.get(SECRET_HEADER) != secret:
+            return web.Response(status=403)
+        update = await request.json()
+        with open(log_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({"shard": shard, "pid": os.getpid(), "update": update}, ensure_ascii=False) + "\n")
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(f"/{WORKER_PATH}", receive)
+    web.run_app(app, host="127.0.0.1", port=int(os.environ["PORT"]), print=None, access_log=None)
+
+
+async def run_selftest(workers: int, users: int, messages: int, port: int) -> bool:
+    logging.getLogger("aiohttp.access").setLevel(logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix="mahiro-shards-")
+    log_path = os.path.join(workdir, "received.jsonl")
+    ready, stop = asyncio.Event(), asyncio.Event()
+    ingress = asyncio.get_running_loop().create_task(run_ingress(
+        workers, "127.0.0.1", port, "telegram", spawn_workers=True, ready=ready, stop=stop,
+        worker_command=[sys.executable, os.path.abspath(__file__), "echo-worker", "--log", log_path]
+    ))
+    await ready.wait()
+
+    def received():
+        if not os.path.exists(log_path):
+            return []
+        with open(log_path, encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    user_ids = [1000 + i for i in range(users)]
+    async with ClientSession() as session:
+        async def send(user_id, n):
+            update = fake_update(f"msg {n}", user_id)
+            update["update_id"] = user_id * 1000 + n
+            async with session.post(f"http://127.0.0.1:{port}/telegram", json=update) as response:
+                assert response.status == 200, response.status
+
+        for n in range(messages):
+            if n == messages // 2:
+                # نقتل عاملاً في منتصف الاختبار ليعيد الـ ingress تشغيله
+                while not received():
+                    await asyncio.sleep(0.1)
+                victim = received()[0]
+                os.kill(victim["pid"], signal.SIGKILL)
+                logger.info(f"Killed shard {victim['shard']} worker (pid {victim['pid']})")
+            # رسالة n لكل المستخدمين معاً، والرسالة التالية لكل مستخدم بعد قبول السابقة
+            await asyncio.gather(*(send(user_id, n) for user_id in user_ids))
+
+    deadline = time.monotonic() + 60
+    expected = users * messages
+    while time.monotonic() < deadline and len({r["update"]["update_id"] for r in received()}) < expected:
+        await asyncio.sleep(0.5)
+
+    records = received()
+    ok = True
+    seen = {}
+    for record in records:
+        update = record["update"]
+        user_id = update["message"]["from"]["id"]
+        if record["shard"] != shard_for(user_id, workers):
+            logger.error(f"User {user_id} reached shard {record['shard']}, expected {shard_for(user_id, workers)}")
+            ok = False
+        n = int(update["message"]["text"].split()[1])
+        order = seen.setdefault(user_id, [])
+        if n in order:
+            continue # إعادة إرسال بعد موت العامل (توصيل مرة واحدة على الأقل)
+        if order and n < order[-1]:
+            logger.error(f"User {user_id} received message {n} after {order[-1]}")
+            ok = False
+        order.append(n)
+    missing = expected - sum(len(order) for order in seen.values())
+    if missing:
+        logger.error(f"{missing} updates were never delivered")
+        ok = False
+    pids = {record["shard"]: set() for record in records}
+    for record in records:
+        pids[record["shard"]].add(record["pid"])
+    restarted = sorted(shard for shard, shard_pids in pids.items() if len(shard_pids) > 1)
+
+    print(f"{len(records)} deliveries of {expected} updates to {workers} shards; "
+          f"per-shard users: {[sum(1 for u in user_ids if shard_for(u, workers) == i) for i in range(workers)]}; "
+          f"restarted shards: {restarted}; {'OK' if ok else 'FAILED'}")
+
+    stop.set()
+    await ingress
+    shutil.rmtree(workdir, ignore_errors=True)
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded deployment of the bot.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ingress = commands.add_parser("ingress", help="route webhook updates to shard workers")
+    ingress.add_argument("--workers", type=int, default=int(os.getenv('SHARD_COUNT', "2")))
+    ingress.add_argument("--port", type=int, default=int(os.getenv('PORT', "5000")))
+    ingress.add_argument("--base-port", type=int, help="port of worker 0 (default: --port + 1)")
+    ingress.add_argument("--no-spawn", action="store_true", help="do not start workers; they are run separately")
+
+    worker = commands.add_parser("worker", help="run one shard worker in the foreground")
+    worker.add_argument("--index", type=int, required=True)
+    worker.add_argument("--count", type=int, default=int(os.getenv('SHARD_COUNT', "2")))
+    worker.add_argument("--base-port", type=int, default=int(os.getenv('PORT', "5000")) + 1)
+
+    echo = commands.add_parser("echo-worker", help=argparse.SUPPRESS)
+    echo.add_argument("--log", required=True)
+
+    selftest = commands.add_parser("selftest", help="local multi-process routing, ordering and restart test")
+    selftest.add_argument("--workers", type=int, default=3)
+    selftest.add_argument("--users", type=int, default=20)
+    selftest.add_argument("--messages", type=int, default=10)
+    selftest.add_argument("--port", type=int, default=8765)
+
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    if args.command == "ingress":
+        if not args.no_spawn:
+            split_state(args.workers, os.getenv('USER_STATE_DB', "user_state.db"), os.getenv('REMINDERS_DB', "reminders.db"))
+        asyncio.run(run_ingress(
+            args.workers, "0.0.0.0", args.port, os.getenv('WEBHOOK_PATH', "telegram"),
+            webhook_url=os.getenv('WEBHOOK_URL'), secret_token=os.getenv('WEBHOOK_SECRET'),
+            token=os.getenv('TELEGRAM_TOKEN'), base_port=args.base_port, spawn_workers=not args.no_spawn
+        ))
+    elif args.command == "worker":
+        if not os.getenv('SHARD_SECRET'):
+            parser.error("SHARD_SECRET must be set to the ingress's value")
+        env = {**os.environ, **shard_env(args.index, args.count, args.base_port, os.environ['SHARD_SECRET'])}
+        os.execve(sys.executable, [sys.executable, BOT_SCRIPT], env)
+    elif args.command == "echo-worker":
+        run_echo_worker(args.log)
+    else:
+        sys.exit(0 if asyncio.run(run_selftest(args.workers, args.users, args.messages, args.port)) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+# storage.py
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from history import encode_json, history_of
+
+logger = logging.getLogger(__name__)
+
+
+class UserStore:
+    """SQLite-backed store for per-user bot state.
+
+    Every user is one row holding that user's record as JSON, so persisting a
+    change rewrites only the record that changed instead of the whole dataset.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS user_state (
+                    user_id TEXT PRIMARY KEY,
+                    data TEXT NOT NULL
+                )
+            """)
+            # أرشيف الرسائل والحقائق القديمة لفهرس الاسترجاع
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS user_archive (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    text TEXT NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_user_archive_user ON user_archive (user_id)")
+            self._conn.commit()
+
+    def load_all(self) -> dict:
+        """Returns every stored user record keyed by user id."""
+        with self._lock:
+            rows = self._conn.execute("SELECT user_id, data FROM user_state").fetchall()
+        return {user_id: self.parse(data) for user_id, data in rows}
+
+    def load(self, user_id) -> dict | None:
+        """Returns a single user record, or None if the user is unknown."""
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM user_state WHERE user_id = ?", (str(user_id),)).fetchone()
+        return self.parse(row[0]) if row else None
+
+    def save(self, user_id, record: dict):
+        """Writes a single user record."""
+        self.save_many([(user_id, record)])
+
+    def save_many(self, items):
+        """Writes several (user_id, record) pairs in one transaction."""
+        self.write_rows([(str(user_id), self.dump(record)) for user_id, record in items])
+
+    @staticmethod
+    def dump(record: dict) -> str:
+        return json.dumps(record, ensure_ascii=False, separators=(',', ':'), default=encode_json)
+
+    @staticmethod
+    def parse(data: str) -> dict:
+        record = json.loads(data)
+        if 'conversation_history' in record:
+            history_of(record) # السجل يبقى في الذاكرة بالشكل المضغوط
+        return record
+
+    def write_rows(self, rows):
+        """Writes already serialized (user_id, data) rows in one transaction.
+
+        The transaction either commits completely or not at all, so a crash
+        mid-flush never leaves a partially written record behind.
+        """
+        if not rows:
+            return
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO user_state (user_id, data) VALUES (?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+                    rows
+                )
+
+    def add_archive(self, user_id, kind: str, texts: list[str]) -> list[int]:
+        """Appends archived texts for a user and returns their row ids."""
+        with self._lock:
+            with self._conn:
+                return [
+                    self._conn.execute(
+                        "INSERT INTO user_archive (user_id, kind, text) VALUES (?, ?, ?)", (str(user_id), kind, text)
+                    ).lastrowid
+                    for text in texts
+                ]
+
+    def load_archive(self, user_id) -> list[tuple]:
+        """Returns every archived (id, kind, text) row of a user."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, kind, text FROM user_archive WHERE user_id = ? ORDER BY id", (str(user_id),)
+            ).fetchall()
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM user_state").fetchone()[0]
+
+    def migrate_from_json(self, json_path: str) -> int:
+        """One-time import of the legacy user_data.json file.
+
+        The import only runs while the store is empty; afterwards the JSON
+        file is renamed to ``<name>.migrated`` so it is never imported twice.
+        Returns the number of migrated users.
+        """
+        if not os.path.exists(json_path) or self.count():
+            return 0
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                legacy_data = json.load(f)
+        except json.JSONDecodeError as e:
+            logger.error(f"Could not migrate {json_path}: {e}")
+            return 0
+
+        self.save_many(legacy_data.items())
+        os.replace(json_path, json_path + ".migrated")
+        logger.info(f"Migrated {len(legacy_data)} users from {json_path} to {self.path}")
+        return len(legacy_data)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class UserCache(MutableMapping):
+    """Bounded LRU view of the user records, loaded from the store on first use.
+
+    Behaves like the ``user_data`` dict for the bot: a lookup that misses the
+    cache reads that single user from SQLite. When more than ``max_size``
+    records are cached the least recently used ones are dropped, except those
+    for which ``is_pinned(user_id)`` is true (records with unsaved changes).
+    Iteration and ``len`` only cover the cached records.
+    """
+
+    def __init__(self, store: UserStore, max_size: int = 5000, is_pinned=None):
+        self.store = store
+        self.max_size = max_size
+        self.is_pinned = is_pinned or (lambda user_id: False)
+        self._records = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __getitem__(self, user_id):
+        user_id = str(user_id)
+        record = self._records.get(user_id)
+        if record is not None:
+            self.hits += 1
+            self._records.move_to_end(user_id)
+            return record
+        self.misses += 1
+        record = self.store.load(user_id)
+        if record is None:
+            raise KeyError(user_id)
+        self[user_id] = record
+        return record
+
+    def __setitem__(self, user_id, record):
+        user_id = str(user_id)
+        self._records[user_id] = record
+        self._records.move_to_end(user_id)
+        self._evict()
+
+    def __delitem__(self, user_id):
+        del self._records[str(user_id)]
+
+    def __contains__(self, user_id):
+        try:
+            self[user_id]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(list(self._records))
+
+    def __len__(self):
+        return len(self._records)
+
+    def clear(self):
+        self._records.clear()
+
+    def peek(self, user_id):
+        """The cached record, or None; never loads from the store."""
+        return self._records.get(str(user_id))
+
+    def _evict(self):
+        excess = len(self._records) - self.max_size
+        if excess <= 0:
+            return
+        # السجل الأحدث هو الذي أُضيف للتو ولم يُعلَّم كمعدل بعد، فلا نُخرجه
+        for user_id in list(self._records)[:-1]:
+            if excess <= 0:
+                break
+            if not self.is_pinned(user_id):
+                del self._records[user_id]
+                excess -= 1
+
+
+class StateWriter:
+    """Background writer that coalesces user-state changes.
+
+    Handlers only call ``mark_dirty``; a single asyncio task collects the dirty
+    user ids and, once per ``flush_interval`` seconds, serializes those records
+    and writes them in one transaction on a dedicated writer thread, so the
+    event loop never waits on disk I/O.
+    """
+
+    def __init__(self, store: UserStore, records: dict, flush_interval: float = 2.0):
+        self.store = store
+        self.records = records
+        self.flush_interval = flush_interval
+        self._dirty = set()
+        self._writing = set()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-writer")
+        self._task = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._dirty)
+
+    def mark_dirty(self, user_id):
+        self._dirty.add(str(user_id))
+
+    def is_dirty(self, user_id) -> bool:
+        """True while the user's changes are not yet safely on disk."""
+        user_id = str(user_id)
+        return user_id in self._dirty or user_id in self._writing
+
+    def _take_snapshot(self):
+        dirty, self._dirty = self._dirty, set()
+        # peek بدلاً من "in" حتى لا يعيد UserCache تحميل نسخة قديمة من القرص ثم يكتبها فوق الأحدث
+        peek = getattr(self.records, 'peek', self.records.get)
+        records = [(user_id, peek(user_id)) for user_id in dirty]
+        # التسلسل يتم هنا على حلقة الأحداث حتى لا يتغير السجل أثناء كتابته
+        return [(user_id, self.store.dump(record)) for user_id, record in records if record is not None]
+
+    async def flush(self):
+        rows = self._take_snapshot()
+        if not rows:
+            return
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        self._writing = {user_id for user_id, _ in rows}
+        try:
+            await loop.run_in_executor(self._executor, self.store.write_rows, rows)
+            metrics.histogram("state_flush_seconds", "Duration of one user-state flush.").observe(time.perf_counter() - started)
+            metrics.counter("state_flush_bytes_total", "Serialized user-state bytes written.").inc(sum(len(data.encode('utf-8')) for _, data in rows))
+            metrics.counter("state_flush_records_total", "User records written by the state writer.").inc(len(rows))
+        except Exception as e:
+            logger.error(f"State flush failed for {len(rows)} users, will retry: {e}")
+            self._dirty.update(user_id for user_id, _ in rows)
+        finally:
+            self._writing = set()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if self._dirty:
+                await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Stops the periodic flush and writes whatever is still pending."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        self._executor.shutdown(wait=True)
+        logger.info("User state flushed on shutdown.")
@@ -0,0 +1,34 @@
+# test_intent_classifier.py
+import pytest
+
+from intent_classifier import IntentClassifier
+
+classifier = IntentClassifier(threshold=0.7)
+
+
+@pytest.mark.parametrize("text, intent, data", [
+    ("ذكريني بشرب الماء بعد ساعة", "reminder", "شرب الماء بعد ساعة"),
+    ("remind me to call mom in 20 minutes", "reminder", "call mom in 20 minutes"),
+    ("ابحثي عن أفضل وصفات الأرز", "search", "أفضل وصفات الأرز"),
+    ("دوري لي عن مطعم قريب", "search", "مطعم قريب"),
+    ("search for rice recipes", "search", "rice recipes"),
+    ("تذكري أني أحب القهوة", "remember_fact", "أني أحب القهوة"),
+    ("remember that my birthday is in May", "remember_fact", "my birthday is in May"),
+])
+def test_requests_are_routed_locally(text, intent, data):
+    result = classifier.classify(text)
+    assert (result.intent, result.data) == (intent, data)
+    assert result.confidence >= classifier.threshold
+
+
+@pytest.mark.parametrize("text", [
+    "دور الشمس في الحياة مهم",
+    "ذكرني كيف كان يومك",
+    "فكرني شو كنا نحكي",
+    "remember when we went to the beach?",
+    "تذكر لما كنا صغار؟",
+    "google is great",
+    "look up at the sky",
+])
+def test_chat_sharing_a_request_verb_goes_to_the_llm(text):
+    assert classifier.classify(text).confidence < classifier.threshold
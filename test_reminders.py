@@ -0,0 +1,76 @@
+# test_reminders.py
+import asyncio
+import time
+from types import SimpleNamespace
+
+from reminders import ReminderScheduler, ReminderStore
+
+
+class RetryAfter(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Flood control exceeded. Retry in {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+def make_scheduler(tmp_path, callback, **kwargs):
+    scheduler = ReminderScheduler(ReminderStore(str(tmp_path / "reminders.db")), callback, **kwargs)
+    scheduler._application = SimpleNamespace(bot=None)
+    return scheduler
+
+
+async def load_due(scheduler, count):
+    for i in range(count):
+        await scheduler.schedule(i, -1, {"task": str(i)})
+    await scheduler._refill(time.time())
+    return sorted(scheduler._heap.pop() for _ in range(len(scheduler._heap)))
+
+
+def test_failed_sends_stay_pending_and_are_retried(tmp_path):
+    async def callback(context):
+        if context.job.data["task"] == "1":
+            raise RuntimeError("Timed out")
+
+    async def run():
+        scheduler = make_scheduler(tmp_path, callback)
+        batch = await load_due(scheduler, 3)
+        await scheduler._deliver(batch)
+        assert scheduler.store.pending_count() == 1
+        assert [item[1] for item in scheduler._heap] == [2]
+        assert 2 in scheduler._scheduled
+
+    asyncio.run(run())
+
+
+def test_retry_after_pauses_the_rest_of_the_batch(tmp_path):
+    sent = []
+
+    async def callback(context):
+        if context.job.data["task"] == "0":
+            raise RetryAfter(30)
+        sent.append(context.job.id)
+
+    async def run():
+        scheduler = make_scheduler(tmp_path, callback, max_per_second=1)
+        batch = await load_due(scheduler, 3)
+        await scheduler._deliver(batch)
+        assert sent == []
+        assert scheduler.store.pending_count() == 3
+        assert all(due_at > batch[-1][0] + 29 for due_at, *_ in scheduler._heap)
+
+    asyncio.run(run())
+
+
+def test_gives_up_after_max_attempts(tmp_path):
+    async def callback(context):
+        raise RuntimeError("Forbidden: bot was blocked by the user")
+
+    async def run():
+        scheduler = make_scheduler(tmp_path, callback, max_attempts=2, retry_base=0)
+        batch = await load_due(scheduler, 1)
+        await scheduler._deliver(batch)
+        assert scheduler.store.pending_count() == 1
+        await scheduler._deliver([scheduler._heap.pop()])
+        assert scheduler.store.pending_count() == 0
+        assert not scheduler._heap and not scheduler._scheduled
+
+    asyncio.run(run())
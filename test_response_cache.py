@@ -0,0 +1,27 @@
+# test_response_cache.py
+import pytest
+
+from response_cache import NAME_PLACEHOLDER, depersonalize, mentions_name, personalize
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("أهلاً أحمد!", "أهلاً {}!"),
+    ("هذه الوصفة لأحمد", "هذه الوصفة ل{}"),
+    ("وأحمد يحب الأرز", "و{} يحب الأرز"),
+    ("فأحمد، جرب هذا", "ف{}، جرب هذا"),
+    ("مرحباً بأحمد وكأحمد ولأحمد", "مرحباً ب{} وك{} ول{}"),
+    ("أحمدي ليست اسماً", "أحمدي ليست اسماً"),
+])
+def test_name_and_arabic_proclitics_are_replaced(text, expected):
+    answer = depersonalize(text, "أحمد")
+    assert answer == expected.replace("{}", NAME_PLACEHOLDER)
+    assert personalize(answer, "سارة") == expected.replace("{}", "سارة")
+
+
+def test_english_name_only_as_whole_word():
+    assert depersonalize("Ali, quality matters", "Ali") == f"{NAME_PLACEHOLDER}, quality matters"
+
+
+def test_leftover_name_is_detected():
+    assert mentions_name(depersonalize("صديقتك أحمدة", "أحمد"), "أحمد")
+    assert not mentions_name(depersonalize("لأحمد ولك", "أحمد"), "أحمد")
@@ -0,0 +1,37 @@
+# test_time_parser.py
+from datetime import datetime
+
+import pytest
+import pytz
+
+from time_parser import parse_reminder
+
+TZ = pytz.timezone("Asia/Riyadh")
+NOW = TZ.localize(datetime(2026, 10, 13, 14, 0)) # الثلاثاء 14:00
+
+
+@pytest.mark.parametrize("text, task, delay", [
+    ("شرب الماء بعد ساعة", "شرب الماء", 3600),
+    ("اتصل بأمي غداً الساعة 5 مساءً", "اتصل بأمي", 27 * 3600),
+    ("call mom in 20 minutes", "call mom", 20 * 60),
+    ("stretch in an hour and a half", "stretch", 90 * 60),
+    ("meeting at 5pm", "meeting", 3 * 3600),
+    ("نام الساعة 11 بالليل", "نام", 9 * 3600),
+])
+def test_understood_times(text, task, delay):
+    assert parse_reminder(text, TZ, now=NOW) == (task, delay)
+
+
+@pytest.mark.parametrize("text", [
+    "الاجتماع يوم الجمعة الساعة 5 مساء", # يوم من الأسبوع
+    "dentist next monday at 9am",
+    "الاجتماع الأسبوع الجاي الساعة 3 العصر",
+    "pay bills on the 25th at 5pm", # تاريخ
+    "renew passport 25/10 at 9am",
+    "call sam at 5 in the morning", # فترة خارج الجزء المفهوم
+    "اتصل بسامي الساعة 7 في الصباح",
+    "in 2 hours and 30 minutes go", # مدة مركبة
+    "بعد ساعة و10 دقائق اطفي الفرن",
+])
+def test_partially_understood_times_fall_back_to_llm(text):
+    assert parse_reminder(text, TZ, now=NOW) is None
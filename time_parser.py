@@ -0,0 +1,201 @@
+# time_parser.py
+"""Deterministic parser for the common Arabic and English reminder times.
+
+``parse_reminder`` turns texts such as "شرب الماء بعد ساعة",
+"اتصل بأمي غداً الساعة 5 مساءً" or "call mom in 20 minutes" into a task and a
+delay in seconds, using the user's pytz timezone for wall-clock times so the
+result stays correct across DST changes. It returns None for anything it is
+not sure about; the caller then falls back to the LLM.
+"""
+import re
+from datetime import datetime, timedelta
+
+import pytz
+
+_DIACRITICS_RE = re.compile(r"[\u064B-\u065F\u0670\u0640]")
+# تحويل حرف بحرف حتى تبقى المواقع في النص الأصلي كما هي
+_MATCH_MAP = str.maketrans("أإآٱىة٠١٢٣٤٥٦٧٨٩", "اااايه0123456789")
+
+NUMBER_WORDS = {
+    "واحد": 1, "واحده": 1, "اثنين": 2, "اثنان": 2, "ثلاث": 3, "ثلاثه": 3, "اربع": 4, "اربعه": 4,
+    "خمس": 5, "خمسه": 5, "ست": 6, "سته": 6, "سبع": 7, "سبعه": 7, "ثمان": 8, "ثماني": 8, "ثمانيه": 8,
+    "تسع": 9, "تسعه": 9, "عشر": 10, "عشره": 10, "احدعش": 11, "اطنعش": 12, "اثنا عشر": 12,
+    "ربع": 0.25, "نص": 0.5, "نصف": 0.5, "عشرين": 20, "ثلاثين": 30, "اربعين": 40, "خمسين": 50,
+    "one": 1, "a": 1, "an": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7,
+    "eight": 8, "nine": 9, "ten": 10, "eleven": 11, "twelve": 12, "fifteen": 15, "twenty": 20,
+    "thirty": 30, "forty": 40, "fifty": 50, "half an": 0.5, "half a": 0.5, "a half": 0.5,
+}
+
+# الوحدة -> (عدد الثواني، هل هي وحدة تقويمية، العدد الضمني إن كانت مثنى)
+UNITS = {
+    "ثانيه": (1, False, 1), "ثواني": (1, False, 1), "ثوان": (1, False, 1), "ثانيتين": (1, False, 2),
+    "دقيقه": (60, False, 1), "دقايق": (60, False, 1), "دقائق": (60, False, 1), "دقيقتين": (60, False, 2), "دقيقتان": (60, False, 2),
+    "ساعه": (3600, False, 1), "ساعات": (3600, False, 1), "ساعتين": (3600, False, 2), "ساعتان": (3600, False, 2),
+    "يوم": (86400, True, 1), "ايام": (86400, True, 1), "يومين": (86400, True, 2), "يومان": (86400, True, 2),
+    "اسبوع": (604800, True, 1), "اسابيع": (604800, True, 1), "اسبوعين": (604800, True, 2), "اسبوعان": (604800, True, 2),
+    "second": (1, False, 1), "seconds": (1, False, 1), "sec": (1, False, 1), "secs": (1, False, 1),
+    "minute": (60, False, 1), "minutes": (60, False, 1), "min": (60, False, 1), "mins": (60, False, 1),
+    "hour": (3600, False, 1), "hours": (3600, False, 1), "hr": (3600, False, 1), "hrs": (3600, False, 1),
+    "day": (86400, True, 1), "days": (86400, True, 1), "week": (604800, True, 1), "weeks": (604800, True, 1),
+}
+
+_alternation = lambda words: "|".join(sorted((re.escape(w) for w in words), key=len, reverse=True))
+_NUMBER = rf"(?:\d+(?:[.,]\d+)?|{_alternation(NUMBER_WORDS)})"
+
+RELATIVE_RE = re.compile(
+    rf"(?:\b(?:in|after|within)|(?<!\S)(?:بعد|خلال|كمان))\s+"
+    rf"(?:(?P<qty>{_NUMBER})\s*)?(?P<unit>{_alternation(UNITS)})\b"
+    rf"(?:\s*(?:و\s*|and\s+)(?P<frac>نص|نصف|ربع|a half|a quarter))?",
+    re.I
+)
+
+DAY_WORDS = {
+    "اليوم": 0, "الليله": 0, "today": 0, "tonight": 0,
+    "غدا": 1, "بكره": 1, "بكرا": 1, "tomorrow": 1,
+    "بعد غد": 2, "بعد بكره": 2, "بعد بكرا": 2, "the day after tomorrow": 2,
+}
+DAY_RE = re.compile(rf"(?<!\S)(?:{_alternation(DAY_WORDS)})(?!\S)", re.I)
+
+# الفترة -> (هل تعني بعد الظهر؟)
+MERIDIEMS = {
+    "am": False, "a.m.": False, "ص": False, "صباحا": False, "الصبح": False, "فجرا": False, "الفجر": False,
+    "pm": True, "p.m.": True, "م": True, "مساء": True, "مساءا": True, "المساء": True, "الظهر": True,
+    "ظهرا": True, "العصر": True, "عصرا": True, "بالليل": True, "ليلا": True, "الليل": True,
+}
+_HOUR = rf"(?P<hour>\d{{1,2}}|{_alternation(w for w, v in NUMBER_WORDS.items() if isinstance(v, int) and 1 <= v <= 12)})"
+_MERIDIEM = rf"(?P<meridiem>{_alternation(MERIDIEMS)})"
+CLOCK_RE = re.compile(
+    rf"(?:(?:(?<!\S)(?:الساعه|عند الساعه|على الساعه)|\bat|@)\s*{_HOUR}(?::(?P<minute>\d{{2}}))?(?:\s*{_MERIDIEM}(?!\w))?"
+    rf"|(?<!\S){_HOUR.replace('hour', 'hour2')}(?::(?P<minute2>\d{{2}}))?\s*{_MERIDIEM.replace('meridiem', 'meridiem2')}(?!\w))",
+    re.I
+)
+
+# --- أشياء لا يفهمها هذا المحلل: وجودها يعني أن الوقت المحسوب قد يكون خاطئاً، فنترك النص للنموذج ---
+WEEKDAYS = [
+    "السبت", "الاحد", "الاثنين", "الثلاثاء", "الاربعاء", "الخميس", "الجمعه",
+    "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday",
+]
+MONTHS = [
+    "يناير", "فبراير", "مارس", "ابريل", "مايو", "يونيو", "يوليو", "اغسطس", "سبتمبر", "اكتوبر", "نوفمبر", "ديسمبر",
+    "كانون", "شباط", "اذار", "نيسان", "ايار", "حزيران", "تموز", "اب", "ايلول", "تشرين",
+    "january", "february", "march", "april", "june", "july", "august", "september", "october", "november", "december",
+]
+QUALIFIERS = ["next", "الجاي", "الجايه", "القادم", "القادمه", "تاريخ"]
+UNSUPPORTED_RE = re.compile(
+    rf"(?<!\w)(?:{_alternation(WEEKDAYS + MONTHS + QUALIFIERS)})(?!\w)"
+    r"|\b\d{1,2}(?:st|nd|rd|th)\b|(?<!\d)\d{1,2}[/.-]\d{1,2}(?!\d)",
+    re.I
+)
+# كلمات الفترة ("in the morning"، "الصبح") ووحدات المدة مفهومة فقط داخل الجزء الذي حللناه،
+# فإن ظهرت خارجه ("at 5 in the morning"، "in 2 hours and 30 minutes") فالوقت لم يُفهم كاملاً
+PERIOD_RE = re.compile(
+    rf"(?<!\w)(?:{_alternation(list(MERIDIEMS) + ['morning', 'afternoon', 'evening', 'night', 'noon', 'midnight', 'صباح', 'الصباح', 'ظهر', 'عصر', 'ليل'])})(?!\w)",
+    re.I
+)
+UNIT_RE = re.compile(rf"(?<!\w)(?:{_alternation(UNITS)})(?!\w)", re.I)
+
+_TASK_EDGE_RE = re.compile(r"^(?:[\s،,.:-]|(?:to|about|that|في|on)\s)+|(?:[\s،,.:!-]|\s(?:في|on|at|و|and))+$", re.I)
+
+
+def _number(value: str) -> float:
+    value = value.lower().replace(",", ".")
+    return float(value) if value[0].isdigit() else NUMBER_WORDS[value]
+
+
+def _localize(tz, naive: datetime) -> datetime:
+    """Attaches ``tz`` to a wall-clock time, resolving DST gaps and overlaps."""
+    try:
+        return tz.localize(naive, is_dst=None)
+    except pytz.AmbiguousTimeError:
+        return tz.localize(naive, is_dst=False)
+    except pytz.NonExistentTimeError:
+        return tz.normalize(tz.localize(naive, is_dst=True))
+
+
+def _clean_task(text: str, spans) -> str:
+    for start, end in sorted(spans, reverse=True):
+        text = text[:start] + " " + text[end:]
+    text = re.sub(r"\s+", " ", text)
+    previous = None
+    while previous != text:
+        previous, text = text, _TASK_EDGE_RE.sub("", text)
+    return text.strip()
+
+
+def _outside(pattern, text: str, spans) -> bool:
+    """True if ``pattern`` matches anywhere not covered by ``spans``."""
+    return any(not any(start <= m.start() and m.end() <= end for start, end in spans) for m in pattern.finditer(text))
+
+
+def parse_reminder(text: str, tz, now: datetime = None):
+    """Returns ``(task, delay_seconds)`` or None when the time is not understood.
+
+    ``tz`` is a pytz timezone; ``now`` defaults to the current time and is
+    mainly there for tests.
+    """
+    original = _DIACRITICS_RE.sub("", text or "")
+    match_text = original.translate(_MATCH_MAP)
+    now = now.astimezone(tz) if now else datetime.now(tz)
+    if UNSUPPORTED_RE.search(match_text):
+        return None
+
+    relative = RELATIVE_RE.search(match_text)
+    day = DAY_RE.search(match_text)
+    clock = CLOCK_RE.search(match_text)
+
+    if relative and not (day or clock):
+        seconds, calendar, implied = UNITS[relative.group("unit").lower()]
+        quantity = _number(relative.group("qty")) if relative.group("qty") else implied
+        if relative.group("frac"):
+            quantity += 0.25 if relative.group("frac") in ("ربع", "a quarter") else 0.5
+        if calendar:
+            # الأيام والأسابيع تُحسب على ساعة الحائط حتى لا يزيحها تغيير التوقيت الصيفي
+            target = _localize(tz, now.replace(tzinfo=None) + timedelta(seconds=seconds * quantity))
+        else:
+            target = now + timedelta(seconds=seconds * quantity)
+        spans = [relative.span()]
+    elif clock:
+        hour = clock.group("hour") or clock.group("hour2")
+        minute = int(clock.group("minute") or clock.group("minute2") or 0)
+        meridiem = clock.group("meridiem") or clock.group("meridiem2")
+        hour = int(_number(hour))
+        if hour > 23 or minute > 59:
+            return None
+        if meridiem:
+            if hour > 12:
+                return None
+            afternoon = MERIDIEMS[meridiem.lower()]
+            hour = hour % 12 + (12 if afternoon else 0)
+            candidates = [hour]
+        elif hour > 12 or hour == 0:
+            candidates = [hour]
+        elif day:
+            return None # "غداً الساعة 5" بدون صباحاً/مساءً غامضة، نتركها للنموذج
+        else:
+            candidates = [hour % 12, hour % 12 + 12]
+
+        day_offset = DAY_WORDS[day.group(0).lower()] if day else 0
+        base_date = now.date() + timedelta(days=day_offset)
+        target = None
+        for extra_days in (0, 1):
+            for candidate in candidates:
+                naive = datetime.combine(base_date + timedelta(days=extra_days), datetime.min.time()).replace(hour=candidate, minute=minute)
+                option = _localize(tz, naive)
+                if option > now and (target is None or option < target):
+                    target = option
+            if target or day:
+                break
+        if target is None:
+            return None
+        spans = [clock.span()] + ([day.span()] if day else [])
+    else:
+        return None
+
+    if _outside(PERIOD_RE, match_text, spans) or _outside(UNIT_RE, match_text, spans):
+        return None
+
+    delay = int((target - now).total_seconds())
+    task = _clean_task(original, spans)
+    if delay <= 0 or not task:
+        return None
+    return task, delay
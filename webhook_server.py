@@ -0,0 +1,130 @@
+# webhook_server.py
+"""Webhook deployment: one aiohttp server for Telegram updates and health checks.
+
+In this mode there is no polling loop, no Flask thread and no keep-alive
+pinger: Telegram pushes updates to ``POST /<path>`` and Render's health
+checks hit ``GET /`` (and scrapers ``GET /metrics``) on the same event loop
+the bot runs on.
+
+Run ``python webhook_server.py --url http://localhost:5000/telegram "مرحبا"``
+to post a fake update to a locally running webhook for testing.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import signal
+import time
+import urllib.request
+
+from aiohttp import web
+from telegram import Update
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+HOME_TEXT = "✅ Mahiro is awake, living in her digital world."
+
+
+def create_webhook_app(application, url_path: str, secret_token: str = None) -> web.Application:
+    async def home(request):
+        return web.Response(text=HOME_TEXT)
+
+    async def metrics_endpoint(request):
+        return web.Response(body=metrics.render_prometheus().encode('utf-8'), headers={"Content-Type": metrics.PROMETHEUS_CONTENT_TYPE})
+
+    async def telegram_update(request):
+        if secret_token and request.headers.get(SECRET_HEADER) != secret_token:
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except (json.JSONDecodeError, ValueError, KeyError) as e:
+            logger.warning(f"Rejected malformed webhook update: {e}")
+            return web.Response(status=400)
+        # الرد 200 يعني أن التحديث وصل إلى الطابور في الذاكرة فقط، لا أنه عولج؛
+        # إذا توقفت العملية قبل معالجته فلن يعيد المرسل إرساله
+        await application.update_queue.put(update)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_get("/", home)
+    app.router.add_get("/metrics", metrics_endpoint)
+    app.router.add_post(f"/{url_path.strip('/')}", telegram_update)
+    return app
+
+
+async def run_webhook(application, host: str, port: int, url_path: str, webhook_url: str = None,
+                      secret_token: str = None, on_startup=None, on_shutdown=None):
+    """Serves the bot over a webhook until SIGINT/SIGTERM.
+
+    PTB does not call post_init/post_shutdown outside ``run_polling``, so
+    the bot's startup and shutdown hooks are passed in and called here.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    runner = web.AppRunner(create_webhook_app(application, url_path, secret_token))
+    async with application:
+        if on_startup:
+            await on_startup(application)
+        await application.start()
+        if webhook_url:
+            await application.bot.set_webhook(
+                url=f"{webhook_url.rstrip('/')}/{url_path.strip('/')}",
+                secret_token=secret_token,
+                allowed_updates=Update.ALL_TYPES
+            )
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logger.info(f"Webhook server listening on {host}:{port}/{url_path.strip('/')}")
+        try:
+            await stop.wait()
+        finally:
+            await runner.cleanup()
+            await application.stop()
+            if on_shutdown:
+                await on_shutdown(application)
+
+
+# --- أداة اختبار محلية: إرسال تحديث مزيف إلى الـ webhook ---
+def fake_update(text: str, user_id: int = 1, first_name: str = "Tester") -> dict:
+    now = int(time.time())
+    return {
+        "update_id": now,
+        "message": {
+            "message_id": now,
+            "date": now,
+            "chat": {"id": user_id, "type": "private", "first_name": first_name},
+            "from": {"id": user_id, "is_bot": False, "first_name": first_name},
+            "text": text,
+            **({"entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]} if text.startswith("/") else {}),
+        },
+    }
+
+
+def post_fake_update(url: str, text: str, user_id: int = 1, secret_token: str = None) -> int:
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(fake_update(text, user_id)).encode('utf-8'),
+        headers={"Content-Type": "application/json", **({SECRET_HEADER: secret_token} if secret_token else {})},
+        method="POST"
+    )
+    with urllib.request.urlopen(request) as response:
+        return response.status
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Post a fake Telegram update to a local webhook.")
+    parser.add_argument("text")
+    parser.add_argument("--url", default="http://localhost:5000/telegram")
+    parser.add_argument("--user-id", type=int, default=1)
+    parser.add_argument("--secret")
+    args = parser.parse_args()
+    print(post_fake_update(args.url, args.text, args.user_id, args.secret))